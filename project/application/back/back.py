@@ -1,8 +1,8 @@
 import os
 import json
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
 
 from pydantic import BaseModel
@@ -22,6 +22,9 @@ sys.path.insert(0, str(application_dir))
 sys.path.insert(0, str(back_dir))
 
 from back_segmentation import run_segmentation
+from back_mask import find_mask
+from back_slices import get_slice
+from back_voxels import get_header, get_voxels, parse_range
 
 # Import slice function - adjust path based on where script is run from
 try:
@@ -36,7 +39,8 @@ except ImportError:
     spec.loader.exec_module(slice_module)
     extract_files = slice_module.extract_files
 
-from back_report import generate_client_report, generate_html, save_html, save_json, load_json, save_pdf
+from back_report import REPORT_FOLDER, generate_client_report, generate_html, save_html, save_json, load_json
+from back_pdf import job_status, shutdown_pool, submit_pdf
 
 from back_environment import PROJECT_ID, REGION, MEDGEMMA_ENDPOINT, RAG_CORPUS
 from back_chat import SYSTEM_PROMPT_CHAT, FIRST_USER_MESSAGE
@@ -75,6 +79,11 @@ class SegmentationResponse(BaseModel):
 
 class ReportResponse(BaseModel):
     response: str
+    pdf_job: Optional[str] = None
+
+# Pre-render every viewer slice to front/public/mri after segmentation. With 0, slices are only
+# rendered when requested through GET /mri/{series}/{kind}/{index}
+PRERENDER_SLICES = os.environ.get("PRERENDER_SLICES", "1") == "1"
 
 # Global variables for mock chat state
 last_client: str = ""
@@ -86,7 +95,8 @@ async def root():
     return {
         "message": "MedGemma API",
         "version": "1.0.0",
-        "endpoints": ["/seg", "/report", "/chat/start", "/chat/send"]
+        "endpoints": ["/seg", "/report", "/report/pdf/{job_id}", "/chat/start", "/chat/send", "/mri/{series}/{kind}/{index}",
+                      "/volume/{series}/{kind}/header", "/volume/{series}/{kind}/data"]
     }
 
 # Generate Segmentations
@@ -113,10 +123,11 @@ async def segmentation():
             raise HTTPException(status_code=500, detail="Segmentation failed for ID 1")
         
         # Extract files after segmentation
-        print("Starting file extraction...")
-        extract_success = extract_files()
-        if not extract_success:
-            raise HTTPException(status_code=500, detail="File extraction failed")
+        if PRERENDER_SLICES:
+            print("Starting file extraction...")
+            extract_success = extract_files()
+            if not extract_success:
+                raise HTTPException(status_code=500, detail="File extraction failed")
         
         print("Segmentation and extraction completed successfully!")
         
@@ -135,17 +146,16 @@ async def segmentation():
 
 # Generate Info file and Report
 @app.post("/report", response_model=ReportResponse)
-async def generate_report(request: ReportRequest):
+def generate_report(request: ReportRequest):
     """
     Report generation endpoint
     Input: client name
-    Output: status confirmation
+    Output: status confirmation, and the id of the PDF job rendering report.pdf in the background
     """
     client_name = request.client_name
     
     # Check if the segmentation has been done
-    seg_file = f"./front/public/mri/0.seg/mri_file.nii"
-    if not os.path.exists(seg_file):
+    if find_mask("./front/public/mri/0.seg") is None:
         print("Starting segmentation process...")
         
         # Run segmentation for ID "0"
@@ -159,10 +169,11 @@ async def generate_report(request: ReportRequest):
             raise HTTPException(status_code=500, detail="Segmentation failed for ID 1")
         
         # Extract files after segmentation
-        print("Starting file extraction...")
-        extract_success = extract_files()
-        if not extract_success:
-            raise HTTPException(status_code=500, detail="File extraction failed")
+        if PRERENDER_SLICES:
+            print("Starting file extraction...")
+            extract_success = extract_files()
+            if not extract_success:
+                raise HTTPException(status_code=500, detail="File extraction failed")
         
         print("Segmentation and extraction completed successfully!")
 
@@ -172,12 +183,95 @@ async def generate_report(request: ReportRequest):
     save_json(info_json)
     html_content = generate_html(info_json)
     save_html(html_content)
-    save_pdf(html_content)
+    # Rendered by the PDF worker pool; poll GET /report/pdf/{pdf_job}
+    pdf_job = submit_pdf(html_content, f"{REPORT_FOLDER}/report.pdf")
 
     return ReportResponse(
-        response=f"Report generated for client: {client_name}"
+        response=f"Report generated for client: {client_name}",
+        pdf_job=pdf_job,
     )
 
+@app.get("/report/pdf/{job_id}")
+def get_pdf_status(job_id: str):
+    """
+    PDF job status endpoint
+    Input: job id returned by /report
+    Output: status ("queued", "running", "done", "failed"), PDF path, error and rendering seconds
+    """
+    status = job_status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Unknown PDF job {job_id}")
+    return status
+
+@app.on_event("shutdown")
+def stop_pdf_workers():
+    shutdown_pool()
+
+# Render a viewer slice on demand
+@app.get("/mri/{series}/{kind}/{index}")
+def get_mri_slice(series: str, kind: str, index: int, level: str = "full", orientation: Optional[str] = None,
+                  if_none_match: str = Header(None)):
+    """
+    Slice endpoint
+    Input: series ("0", "1"), kind ("raw", "seg", "difference"), slice index, level ("full", "half", "thumb"),
+           orientation ("axial", "coronal", "sagittal", default: stored slice axis)
+    Output: JPEG image, rendered on first request and then served from an LRU cache
+    """
+    try:
+        data, etag = get_slice(series, kind, index, level, orientation)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except (FileNotFoundError, IndexError) as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    # Slices change when a series is segmented again: always revalidate, answer 304 if unchanged
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache"}
+    if if_none_match is not None and f'"{etag}"' in if_none_match:
+        return Response(status_code=304, headers=headers)
+    return Response(content=data, media_type="image/jpeg", headers=headers)
+
+# Whole volumes for client-side viewing
+@app.get("/volume/{series}/{kind}/header")
+def get_volume_header(series: str, kind: str):
+    """
+    Volume header endpoint
+    Input: series ("0", "1"), kind ("mri", "seg")
+    Output: shape, spacing, intensity window and chunking of the uint8 volume served by /data
+    """
+    try:
+        return get_header(series, kind)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.get("/volume/{series}/{kind}/data")
+def get_volume_data(series: str, kind: str, range: str = Header(None), if_none_match: str = Header(None)):
+    """
+    Volume data endpoint
+    Input: series, kind, optional "Range: bytes=start-end" header (e.g. a chunk of slices)
+    Output: uint8 voxels in C order, slices along the first axis; 206 for a range
+    """
+    try:
+        header, data = get_voxels(series, kind)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    headers = {"ETag": f'"{header["etag"]}"', "Cache-Control": "no-cache", "Accept-Ranges": "bytes"}
+    if if_none_match is not None and headers["ETag"] in if_none_match:
+        return Response(status_code=304, headers=headers)
+    try:
+        byte_range = parse_range(range, len(data))
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{len(data)}"})
+    if byte_range is None:
+        return Response(content=data, media_type="application/octet-stream", headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+    return Response(content=data[start:end + 1], status_code=206, media_type="application/octet-stream", headers=headers)
+
 last_client = ""
 chat_history = []
 gemma_model = None
@@ -0,0 +1,132 @@
+'''
+Charts of the report, rendered as inline SVG from the metrics
+
+The report used to draw its trend with Chart.js from a CDN, which needs
+JavaScript and network access: the PDF renderer has neither. SVG markup is
+written directly here, so the HTML and the PDF show the same chart, offline,
+and the same metrics always give the same bytes.
+
+Styling follows the former Chart.js line chart: a blue smoothed line, white
+ringed points, light grid lines and bold axis titles.
+'''
+
+import math
+from html import escape
+
+LINE_COLOR = "#3498db"
+GRID_COLOR = "#000"
+GRID_OPACITY = 0.05
+TEXT_COLOR = "#666"
+TITLE_COLOR = "#333"
+FONT = "'Segoe UI', Tahoma, Geneva, Verdana, sans-serif"
+# Chart.js' tension: 0 draws straight segments
+TENSION = 0.3
+# Margins of the plot area: left, right, top, bottom
+MARGINS = (80, 30, 20, 70)
+
+
+def nice_ticks(low, high, count=5):
+    """Round tick values covering [low, high]"""
+    if high <= low:
+        # A single value (or all equal) is centered; all zeros get a 0-1 axis
+        span = abs(low)
+        low, high = (low - span / 2, high + span / 2) if span else (0.0, 1.0)
+    raw_step = (high - low) / max(count - 1, 1)
+    magnitude = 10 ** math.floor(math.log10(raw_step))
+    step = next(m * magnitude for m in (1, 2, 2.5, 5, 10) if m * magnitude >= raw_step)
+    first = math.floor(low / step) * step
+    last = math.ceil(high / step) * step
+    n = int(round((last - first) / step))
+    return [round(first + i * step, 10) for i in range(n + 1)]
+
+
+def _format_tick(value, step):
+    # As many decimals as the step needs, e.g. 2 for 0.25
+    decimals = 0
+    while decimals < 6 and round(step * 10**decimals, 6) % 1:
+        decimals += 1
+    return f"{value:.{decimals}f}"
+
+
+def _smooth_path(points, tension=TENSION):
+    """SVG path through the points, with cubic Bezier segments (Catmull-Rom) when tension > 0"""
+    path = f"M {points[0][0]:.1f} {points[0][1]:.1f}"
+    for i in range(1, len(points)):
+        (x0, y0), (x1, y1) = points[i - 1], points[i]
+        if tension <= 0:
+            path += f" L {x1:.1f} {y1:.1f}"
+            continue
+        xp, yp = points[i - 2] if i >= 2 else (x0, y0)
+        xn, yn = points[i + 1] if i + 1 < len(points) else (x1, y1)
+        c1 = (x0 + (x1 - xp) * tension / 2, y0 + (y1 - yp) * tension / 2)
+        c2 = (x1 - (xn - x0) * tension / 2, y1 - (yn - y0) * tension / 2)
+        path += f" C {c1[0]:.1f} {c1[1]:.1f}, {c2[0]:.1f} {c2[1]:.1f}, {x1:.1f} {y1:.1f}"
+    return path
+
+
+def line_chart_svg(labels, values, y_title, x_title, width=1000, height=400, color=LINE_COLOR):
+    """
+    Line chart as an inline SVG element
+
+    Args:
+        labels (list): X axis label of each point, e.g. scan dates
+        values (list): Y value of each point
+        y_title (str): Y axis title
+        x_title (str): X axis title
+        width (int): Width of the drawing, in SVG units; the element scales to its container
+        height (int): Height of the drawing, in SVG units
+        color (str): Line and point color
+
+    Returns:
+        str: <svg> markup
+    """
+    left, right, top, bottom = MARGINS
+    plot_width = width - left - right
+    plot_height = height - top - bottom
+    ticks = nice_ticks(min(values, default=0.0), max(values, default=1.0))
+    step = ticks[1] - ticks[0]
+
+    def x_of(i):
+        # Points are centered in equal slots, like a category axis
+        return left + plot_width * (i + 0.5) / max(len(values), 1)
+
+    def y_of(value):
+        return top + plot_height * (ticks[-1] - value) / (ticks[-1] - ticks[0])
+
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {width} {height}" width="100%" '
+        f'preserveAspectRatio="xMidYMid meet" font-family="{escape(FONT)}" role="img" '
+        f'aria-label="{escape(y_title)} by {escape(x_title)}">'
+    ]
+    for tick in ticks:
+        y = y_of(tick)
+        parts.append(f'<line x1="{left}" y1="{y:.1f}" x2="{width - right}" y2="{y:.1f}" stroke="{GRID_COLOR}" stroke-opacity="{GRID_OPACITY}"/>')
+        parts.append(
+            # Baseline shifted by about half the font size to center the text on the line
+            f'<text x="{left - 10}" y="{y + 4.5:.1f}" font-size="13" fill="{TEXT_COLOR}" '
+            f'text-anchor="end">{_format_tick(tick, step)}</text>'
+        )
+    for i, label in enumerate(labels):
+        x = x_of(i)
+        parts.append(f'<line x1="{x:.1f}" y1="{top}" x2="{x:.1f}" y2="{top + plot_height}" stroke="{GRID_COLOR}" '
+                     f'stroke-opacity="{GRID_OPACITY}"/>')
+        parts.append(
+            f'<text x="{x:.1f}" y="{top + plot_height + 22}" font-size="13" fill="{TEXT_COLOR}" '
+            f'text-anchor="middle">{escape(str(label))}</text>'
+        )
+    parts.append(
+        f'<text x="{left + plot_width / 2:.1f}" y="{height - 12}" font-size="14" font-weight="bold" '
+        f'fill="{TITLE_COLOR}" text-anchor="middle">{escape(x_title)}</text>'
+    )
+    parts.append(
+        f'<text transform="translate(18 {top + plot_height / 2:.1f}) rotate(-90)" font-size="14" '
+        f'font-weight="bold" fill="{TITLE_COLOR}" text-anchor="middle">{escape(y_title)}</text>'
+    )
+
+    points = [(x_of(i), y_of(value)) for i, value in enumerate(values)]
+    if len(points) > 1:
+        parts.append(f'<path d="{_smooth_path(points)}" fill="none" stroke="{color}" stroke-width="3"/>')
+    for x, y in points:
+        parts.append(f'<circle cx="{x:.1f}" cy="{y:.1f}" r="6" fill="{color}" stroke="#fff" stroke-width="2"/>')
+    parts.append("</svg>")
+    return "".join(parts)
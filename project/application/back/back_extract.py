@@ -0,0 +1,215 @@
+'''
+Code to extract viewer slices incrementally, driven by a manifest per output series
+
+Each output folder gets a manifest.json recording:
+- the render parameters
+- the content hash of every source file (MRI volume, masks)
+- a digest of the inputs of every slice
+
+Slices are written at every resolution level of the pyramid (back_render.py)
+from the same rendered stack. A series whose parameters and sources are
+unchanged, and whose slices are all on disk, is skipped without reading any volume. Otherwise, only slices whose
+inputs changed (e.g. the slices a new mask touches) are rendered and written.
+The manifest is written last, so an interrupted extraction is redone on the
+next run. Masks of another scan are first resampled onto the MRI's grid with
+their registration, which is part of the render parameters.
+'''
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from back_mask import find_mask
+from back_render import (
+    ENCODE_WORKERS, JPEG_QUALITY, MODES, PYRAMID_LEVELS, RED, SLICE_NAME,
+    level_folder, oriented_view, write_atomic, write_slices,
+)
+from back_registration import resample
+from back_volumes import Volume, load_mask_volume, load_volume
+
+MANIFEST_NAME = "manifest.json"
+# Bump when the rendering changes, to re-render every series
+RENDER_VERSION = 2
+
+
+class SeriesSpec:
+    """
+    One output series of slices
+
+    Args:
+        folder (str): Output folder of the slice_XXX.jpg files
+        mri_path (str): MRI volume
+        mask_paths (list): Mask files or segmentation folders: none for "raw", the mask for "overlay",
+                           [after, before] masks for "difference"
+        mode (str): "raw", "overlay" or "difference"
+        levels (tuple): Resolution levels to write (keys of PYRAMID_LEVELS)
+        orientation (str, optional): "axial", "coronal" or "sagittal" from the affine; None slices
+                                     along the stored first axis
+        transforms (list, optional): For each mask, None or the registration (back_registration.py)
+                                     that brings it onto the MRI's grid
+    """
+
+    def __init__(self, folder, mri_path, mask_paths=(), mode="raw", levels=tuple(PYRAMID_LEVELS), orientation=None,
+                 transforms=None):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode '{mode}', expected one of {MODES}")
+        self.folder = folder
+        self.mri_path = mri_path
+        self.mask_paths = [_mask_file(path) for path in mask_paths]
+        self.mode = mode
+        unknown = set(levels) - set(PYRAMID_LEVELS)
+        if unknown:
+            raise ValueError(f"Unknown levels {sorted(unknown)}, expected some of {list(PYRAMID_LEVELS)}")
+        self.levels = {level: PYRAMID_LEVELS[level] for level in levels}
+        self.orientation = orientation
+        self.transforms = list(transforms) if transforms is not None else [None] * len(self.mask_paths)
+        if len(self.transforms) != len(self.mask_paths):
+            raise ValueError(f"Expected {len(self.mask_paths)} transforms, got {len(self.transforms)}")
+
+    @property
+    def sources(self):
+        return [self.mri_path] + self.mask_paths
+
+    def params(self, quality):
+        return {
+            "render_version": RENDER_VERSION, "mode": self.mode, "jpeg_quality": quality, "color": list(RED),
+            "levels": self.levels, "orientation": self.orientation,
+            "transforms": [None if t is None else t["matrix"] for t in self.transforms],
+        }
+
+
+def _mask_file(path):
+    if not os.path.isdir(path):
+        return path
+    mask_path = find_mask(path)
+    if mask_path is None:
+        raise FileNotFoundError(f"No segmentation mask found in {path}")
+    return mask_path
+
+
+def file_sha256(path, chunk_size=8 * 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_hashes(paths, previous=None):
+    """
+    Content hashes of source files, reusing the previous hash of files whose mtime and size did not change
+
+    Returns:
+        dict: path -> {"sha256", "mtime_ns", "size"}
+    """
+    previous = previous or {}
+    hashes = {}
+    for path in paths:
+        stat = os.stat(path)
+        entry = previous.get(path)
+        if entry is None or entry.get("mtime_ns") != stat.st_mtime_ns or entry.get("size") != stat.st_size:
+            entry = {"sha256": file_sha256(path), "mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+        hashes[path] = entry
+    return hashes
+
+
+def _content_hashes(sources):
+    return {path: entry["sha256"] for path, entry in sources.items()}
+
+
+def read_manifest(folder):
+    try:
+        with open(os.path.join(folder, MANIFEST_NAME), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(folder, manifest):
+    write_atomic(os.path.join(folder, MANIFEST_NAME), json.dumps(manifest, indent=1).encode())
+
+
+def slice_digests(volume, masks):
+    """Digest of the voxels each slice is rendered from"""
+    digests = []
+    for i in range(volume.shape[0]):
+        digest = hashlib.blake2b(np.ascontiguousarray(volume[i]).tobytes(), digest_size=16)
+        for mask in masks:
+            digest.update(np.ascontiguousarray(mask[i]).tobytes())
+        digests.append(digest.hexdigest())
+    return digests
+
+
+def _slice_path(folder, index, level="full"):
+    return os.path.join(level_folder(folder, level), SLICE_NAME.format(index))
+
+
+def _slice_complete(spec, index):
+    return all(os.path.exists(_slice_path(spec.folder, index, level)) for level in spec.levels)
+
+
+def extract_series(specs, workers=ENCODE_WORKERS, quality=JPEG_QUALITY):
+    """
+    Bring the slices of every series up to date with their sources
+
+    Args:
+        specs (list): SeriesSpec of each output series
+        workers (int): Encoding and writing threads
+        quality (int): JPEG quality
+
+    Returns:
+        dict: Output folder -> number of slices written (0 for series that were up to date)
+    """
+    written = {}
+    for spec in specs:
+        manifest = read_manifest(spec.folder) or {}
+        params = spec.params(quality)
+        sources = source_hashes(spec.sources, manifest.get("sources"))
+        old_digests = manifest.get("slices", []) if manifest.get("params") == params else []
+
+        up_to_date = (
+            manifest.get("params") == params
+            and _content_hashes(sources) == _content_hashes(manifest.get("sources", {}))
+            and all(_slice_complete(spec, i) for i in range(len(old_digests)))
+        )
+        if up_to_date:
+            written[spec.folder] = 0
+            continue
+
+        mri = load_volume(spec.mri_path)
+        volume = oriented_view(mri.data, mri.affine, spec.orientation)
+        masks = []
+        for path, transform in zip(spec.mask_paths, spec.transforms):
+            mask = load_mask_volume(path)
+            if transform is not None:
+                mask = Volume(path, resample(mask.data, transform["matrix"], mri.shape), mri.affine)
+            if mask.shape != mri.shape:
+                raise ValueError(f"Mask shape {mask.shape} does not match volume shape {mri.shape}")
+            # Oriented with the MRI's affine, so voxels stay aligned
+            masks.append(oriented_view(mask.data, mri.affine, spec.orientation))
+        digests = slice_digests(volume, masks)
+
+        # Slices whose inputs changed, or whose file went missing
+        changed = [
+            i for i, digest in enumerate(digests)
+            if i >= len(old_digests) or old_digests[i] != digest or not _slice_complete(spec, i)
+        ]
+        for level in spec.levels:
+            os.makedirs(level_folder(spec.folder, level), exist_ok=True)
+        # Rendered slab by slab, encoded and written on the pool; every level comes from the same rendered slab
+        write_slices(
+            volume, lambda i, level: _slice_path(spec.folder, i, level), masks, spec.mode, changed, spec.levels,
+            workers=workers, quality=quality,
+        )
+
+        # Slices of a former, longer volume
+        for i in range(len(digests), len(old_digests)):
+            for level in spec.levels:
+                if os.path.exists(_slice_path(spec.folder, i, level)):
+                    os.remove(_slice_path(spec.folder, i, level))
+
+        write_manifest(spec.folder, {"params": params, "sources": sources, "slices": digests})
+        written[spec.folder] = len(changed)
+    return written
@@ -0,0 +1,80 @@
+'''
+Physical size of the voxels of a volume, for every measurement of the backend
+
+The spacing is read once per volume, from the NIfTI header zooms (converted
+from the header's spatial unit) of MRI volumes and masks alike, or from the
+affine for volumes derived in memory (e.g. resampled masks), and kept with
+the cached volume handle (back_volumes.py). Metrics then
+convert voxel counts and voxel offsets to cm, cm^2 and cm^3 in vectorized
+form, so scans from any scanner or protocol are measured in the same units.
+'''
+
+import numpy as np
+
+# cm per spatial unit of a NIfTI header; "unknown" is taken as mm, the NIfTI convention
+UNIT_TO_CM = {"meter": 100.0, "mm": 0.1, "micron": 1e-4, "unknown": 0.1}
+
+
+class VoxelGeometry:
+    """
+    Voxel spacing of a volume along its array axes
+
+    Args:
+        spacing (tuple): Voxel size along each array axis, in cm
+        affine (np.ndarray, optional): Voxel to world (mm) affine
+    """
+
+    def __init__(self, spacing, affine=None):
+        self.spacing = np.asarray(spacing, dtype=np.float64)
+        self.affine = affine
+
+    @property
+    def spacing_mm(self):
+        return self.spacing * 10
+
+    @property
+    def voxel_volume(self):
+        """Volume of a voxel, in cm^3"""
+        return float(np.prod(self.spacing))
+
+    def pixel_area(self, axis=0):
+        """Area of a voxel in the slices across `axis`, in cm^2"""
+        return float(np.prod(np.delete(self.spacing, axis)))
+
+    def slice_distance(self, axis=0):
+        """Distance between slices across `axis`, in cm"""
+        return float(self.spacing[axis])
+
+    def volume(self, voxels):
+        """Voxel counts (scalar or array) to cm^3"""
+        return np.asarray(voxels) * self.voxel_volume
+
+    def area(self, pixels, axis=0):
+        """Pixel counts of slices across `axis` (scalar or array) to cm^2"""
+        return np.asarray(pixels) * self.pixel_area(axis)
+
+    def points(self, indices):
+        """Voxel indices (N x 3) to positions in cm, relative to voxel (0, 0, 0)"""
+        return np.asarray(indices) * self.spacing
+
+    def distance(self, offsets):
+        """Lengths in cm of voxel offsets (... x 3)"""
+        return np.sqrt(((np.asarray(offsets) * self.spacing) ** 2).sum(axis=-1))
+
+    def __repr__(self):
+        return f"VoxelGeometry(spacing_mm={[round(float(s), 4) for s in self.spacing_mm]})"
+
+
+def geometry_from_affine(affine):
+    """Geometry of a volume from its voxel to world (mm) affine"""
+    spacing_mm = np.sqrt((np.asarray(affine, dtype=np.float64)[:3, :3] ** 2).sum(axis=0))
+    return VoxelGeometry(spacing_mm / 10, affine)
+
+
+def geometry_from_header(header, affine=None):
+    """Geometry of a volume from its NIfTI header zooms, in the header's spatial unit"""
+    spatial_unit = header.get_xyzt_units()[0]
+    zooms = np.asarray(header.get_zooms()[:3], dtype=np.float64)
+    if affine is None:
+        affine = header.get_best_affine()
+    return VoxelGeometry(zooms * UNIT_TO_CM.get(spatial_unit, UNIT_TO_CM["unknown"]), affine)
@@ -3,13 +3,12 @@ Script to handle analysis of patient IRM and seg
 '''
 # Dependencies
 import base64
-import nibabel as nib
-import numpy as np
 import cv2
 import io
 from PIL import Image
 from google.cloud import aiplatform
 
+from back_volumes import load_seg
 from back_environment import PROJECT_ID, REGION, MEDGEMMA_FT_ENDPOINT_ID, MEDGEMMA_FT_ENDPOINT_REGION, MEDGEMMA_ENDPOINT_ID, MEDGEMMA_ENDPOINT_REGION
 
 def run_analysis_location(id):
@@ -34,12 +33,8 @@ def run_analysis_location(id):
         location=MEDGEMMA_FT_ENDPOINT_REGION,
     )
 
-    # Load MRI data using nibabel and process each slice
-    mri_file_path = f"./front/public/mri/{id}.seg/mri_file.nii"
-    
-    # Load the NIfTI file
-    img = nib.load(mri_file_path)
-    data = img.get_fdata()
+    # Load the segmentation mask (NIfTI or RLE) and process each slice
+    data = load_seg(id).data
 
     # Prompt 
     BRAIN_CLASSES = [
@@ -0,0 +1,188 @@
+'''
+Lesion statistics of a segmentation mask, from a single labelling pass
+
+A mask is labelled once into connected components (the lesions). Everything
+else comes from the labels: voxel counts and per-slice areas from one
+vectorized pass each, and the diameter of each lesion from its bounding box
+given by `find_objects`, so no other full-volume pass is needed:
+- voxel count, physical volume and maximum diameter of each lesion
+- lesion area of each slice (along the first axis)
+- the slice where two masks differ the most, searched only across the slices
+  that hold lesions in either mask
+
+Physical units (cm, cm^2, cm^3) come from the voxel geometry of the mask
+(back_geometry.py).
+'''
+
+import numpy as np
+from scipy.ndimage import binary_erosion, find_objects, label
+from scipy.spatial import ConvexHull, QhullError
+from scipy.spatial.distance import cdist
+
+# Lesions up to this many voxels are measured on all their voxels, without a hull
+SMALL_LESION_VOXELS = 64
+# Rows of the pairwise distance matrix computed at a time
+DISTANCE_CHUNK = 1024
+
+
+class Lesion:
+    """One connected component of a mask"""
+
+    def __init__(self, id, bbox, voxels, volume, max_diameter):
+        self.id = id
+        self.bbox = bbox
+        self.voxels = voxels
+        self.volume = volume
+        self.max_diameter = max_diameter
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "bbox": [[s.start, s.stop] for s in self.bbox],
+            "voxels": self.voxels,
+            "volume": self.volume,
+            "max_diameter": self.max_diameter,
+        }
+
+
+class LesionAnalysis:
+    """
+    Lesions of a mask and their totals
+
+    Attributes:
+        mask (np.ndarray): The analyzed mask
+        labels (np.ndarray): Connected component labels, 0 for background
+        lesions (list): Lesion of each label, in label order
+        slice_voxels (np.ndarray): Lesion voxels of each slice along the first axis
+        geometry (VoxelGeometry): Voxel spacing of the mask
+    """
+
+    def __init__(self, mask, labels, lesions, slice_voxels, geometry):
+        self.mask = mask
+        self.labels = labels
+        self.lesions = lesions
+        self.slice_voxels = slice_voxels
+        self.geometry = geometry
+
+    @property
+    def count(self):
+        return len(self.lesions)
+
+    @property
+    def voxels(self):
+        return int(self.slice_voxels.sum())
+
+    @property
+    def volume(self):
+        return float(self.geometry.volume(self.voxels))
+
+    @property
+    def max_diameter(self):
+        return max((lesion.max_diameter for lesion in self.lesions), default=0.0)
+
+    @property
+    def slice_areas(self):
+        """Lesion area of each slice, in cm^2"""
+        return self.geometry.area(self.slice_voxels)
+
+    def slice_range(self):
+        """(first, stop) slices holding lesions, or None for an empty mask"""
+        if not self.lesions:
+            return None
+        return (
+            min(lesion.bbox[0].start for lesion in self.lesions),
+            max(lesion.bbox[0].stop for lesion in self.lesions),
+        )
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "volume": self.volume,
+            "max_diameter": self.max_diameter,
+            "lesions": [lesion.to_dict() for lesion in self.lesions],
+        }
+
+
+def _max_pairwise_distance(points):
+    """Largest distance between two of the points, without holding the full distance matrix"""
+    best = 0.0
+    for start in range(0, len(points), DISTANCE_CHUNK):
+        best = max(best, float(cdist(points[start:start + DISTANCE_CHUNK], points).max()))
+    return best
+
+
+def max_feret_diameter(component, geometry):
+    """
+    Maximum Feret (caliper) diameter of a lesion: the largest distance between two of its voxel centers
+
+    The two farthest voxels lie on the convex hull of the lesion's surface
+    voxels, so only the hull vertices are compared.
+
+    Args:
+        component (np.ndarray): Boolean crop of the lesion (e.g. its find_objects bounding box)
+        geometry (VoxelGeometry): Voxel spacing of the volume the crop comes from
+
+    Returns:
+        float: Diameter in cm
+    """
+    if np.count_nonzero(component) > SMALL_LESION_VOXELS:
+        # Voxels whose 6-neighbourhood leaves the lesion; the crop border counts as outside
+        component = component & ~binary_erosion(component)
+    points = geometry.points(np.argwhere(component))
+    if len(points) > SMALL_LESION_VOXELS:
+        try:
+            points = points[ConvexHull(points).vertices]
+        except QhullError:
+            # Flat lesion (a single slice or row): joggle the input, hull vertices are still input points
+            points = points[ConvexHull(points, qhull_options="QJ").vertices]
+    return _max_pairwise_distance(points)
+
+
+def analyze_lesions(mask, geometry):
+    """
+    Label a mask once and measure each of its lesions
+
+    Args:
+        mask (np.ndarray): Segmentation mask, non-zero voxels are lesion
+        geometry (VoxelGeometry): Voxel spacing of the mask, e.g. the `geometry` of its Volume
+
+    Returns:
+        LesionAnalysis: Lesions with their voxel counts, volumes (cm^3), bounding boxes and diameters (cm)
+    """
+    labels, _ = label(mask)
+    # Two vectorized passes over the labels, however many lesions there are
+    counts = np.bincount(labels.ravel())
+    slice_voxels = np.count_nonzero(labels, axis=(1, 2))
+    lesions = []
+    for id, bbox in enumerate(find_objects(labels), start=1):
+        if bbox is None:
+            continue
+        voxels = int(counts[id])
+        diameter = max_feret_diameter(labels[bbox] == id, geometry) if voxels > 1 else 0.0
+        lesions.append(Lesion(id, bbox, voxels, float(geometry.volume(voxels)), diameter))
+    return LesionAnalysis(mask, labels, lesions, slice_voxels, geometry)
+
+
+def biggest_difference_slice(before, after):
+    """
+    Slice where two masks differ on the most voxels
+
+    Args:
+        before (LesionAnalysis): Analysis of the earlier mask
+        after (LesionAnalysis): Analysis of the later mask, same shape
+
+    Returns:
+        int: Slice index along the first axis, 0 when the masks are identical
+    """
+    if before.mask.shape != after.mask.shape:
+        raise ValueError(f"Mask shapes differ: {before.mask.shape} and {after.mask.shape}")
+    ranges = [r for r in (before.slice_range(), after.slice_range()) if r is not None]
+    if not ranges:
+        return 0
+    # Outside the slices holding lesions, both masks are background
+    start = min(r[0] for r in ranges)
+    stop = max(r[1] for r in ranges)
+    counts = np.count_nonzero(before.mask[start:stop] != after.mask[start:stop], axis=(1, 2))
+    if not counts.any():
+        return 0
+    return start + int(np.argmax(counts))
@@ -0,0 +1,86 @@
+'''
+Code to read and write segmentation masks, either as NIfTI or in the compact RLE format
+'''
+
+import os
+import sys
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+# The codec is shared with the nnU-Net inference service
+NNUNET_INFERENCE_DIR = Path(__file__).parent.parent.parent / "nnunet-inference"
+sys.path.insert(0, str(NNUNET_INFERENCE_DIR))
+
+from mask_codec import RLE_SUFFIX, decode_mask, is_rle_path, nifti_to_rle, rle_to_nifti, write_rle
+
+# File names a segmentation folder may hold, in order of preference
+MASK_FILE_NAMES = [f"mri_file{RLE_SUFFIX}", "mri_file.nii", "mri_file.nii.gz"]
+
+
+def find_mask(seg_dir):
+    """
+    Find the segmentation mask file in a segmentation folder (e.g. "mri/0.seg")
+
+    Args:
+        seg_dir (str): The segmentation folder
+
+    Returns:
+        str: Path of the mask file, or None if the folder holds no mask
+    """
+    for name in MASK_FILE_NAMES:
+        path = os.path.join(seg_dir, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def load_mask(path):
+    """
+    Load a segmentation mask as a uint8 label volume
+
+    Args:
+        path (str): Mask file (.rle, .nii, .nii.gz) or segmentation folder
+
+    Returns:
+        tuple: (uint8 label volume, affine, NIfTI header)
+    """
+    if os.path.isdir(path):
+        mask_path = find_mask(path)
+        if mask_path is None:
+            raise FileNotFoundError(f"No segmentation mask found in {path}")
+        path = mask_path
+
+    if is_rle_path(path):
+        with open(path, "rb") as f:
+            mask, header = decode_mask(f.read())
+        return mask, header.get_best_affine(), header
+
+    img = nib.load(path)
+    return np.asanyarray(img.dataobj).astype(np.uint8), img.affine, img.header
+
+
+def save_mask(path, mask, affine):
+    """
+    Save a segmentation mask, as RLE if `path` ends with the RLE suffix and as NIfTI otherwise
+
+    Returns:
+        str: The path written
+    """
+    mask = np.asarray(mask, dtype=np.uint8)
+    if is_rle_path(path):
+        write_rle(path, mask, affine=affine)
+    else:
+        nib.save(nib.Nifti1Image(mask, affine), path)
+    return path
+
+
+def convert_mask(src, dst):
+    """Loss-free conversion between NIfTI and RLE masks, based on file names"""
+    if is_rle_path(src) and not is_rle_path(dst):
+        return rle_to_nifti(src, dst)
+    if not is_rle_path(src) and is_rle_path(dst):
+        nifti_to_rle(src, dst)
+        return dst
+    raise ValueError(f"Cannot convert {src} to {dst}: expected one RLE and one NIfTI path")
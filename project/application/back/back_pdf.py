@@ -0,0 +1,302 @@
+'''
+Pool of long-lived worker processes rendering the report PDFs with WeasyPrint
+
+Rendering a PDF takes seconds of layout, and used to run inside the /report
+request on the API process. Instead:
+- each worker process imports WeasyPrint, parses the PDF stylesheet and
+  resolves the fonts once at startup (warm-up render), then waits for jobs
+- jobs are queued and handed to idle workers by a dispatcher thread, so
+  `submit` returns at once and the PDF is written in the background
+- a job running longer than PDF_TIMEOUT seconds gets its worker killed and
+  replaced, and is marked failed; a crashed worker is replaced the same way
+- PDFs are written under a temporary name and renamed when complete
+- when WeasyPrint cannot load or warm up (missing libraries, font errors),
+  or MAX_WARMUP_FAILURES workers in a row die before being ready, PDF
+  rendering is disabled and queued and new jobs fail with the reason
+
+Job states are "queued", "running", "done" and "failed" (see `job_status`).
+'''
+
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.connection import wait
+
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", "2"))
+# Seconds a PDF may take before its worker is killed
+PDF_TIMEOUT = float(os.environ.get("PDF_TIMEOUT", "120"))
+# Finished jobs whose status is kept
+MAX_JOB_HISTORY = 100
+# Workers in a row that may die before being ready, before PDF rendering is disabled
+MAX_WARMUP_FAILURES = 3
+
+PDF_CSS = """
+    @page {
+        size: A4;
+        margin: 1cm;
+    }
+
+    /* Ensure images fit on page */
+    .visualization img {
+        max-width: 100%;
+        height: auto;
+    }
+
+    /* Better chart rendering for PDF */
+    .chart-container {
+        page-break-inside: avoid;
+    }
+
+    /* Prevent page breaks inside metric cards */
+    .metric-card {
+        page-break-inside: avoid;
+    }
+
+    /* Header cards page break control */
+    .header-cards {
+        page-break-inside: avoid;
+    }
+"""
+
+
+def _worker_main(conn):
+    """Worker process: load WeasyPrint and the stylesheet once, then render jobs from `conn`"""
+    try:
+        from weasyprint import CSS, HTML
+        from weasyprint.text.fonts import FontConfiguration
+    except (ImportError, OSError) as e:
+        # OSError when the GTK+ / Pango libraries are missing
+        conn.send(("unavailable", f"WeasyPrint not available: {e}", 0.0))
+        return
+
+    try:
+        font_config = FontConfiguration()
+        stylesheet = CSS(string=PDF_CSS, font_config=font_config)
+        # Resolves and caches the fonts before the first real job
+        HTML(string="<p>warm-up</p>").write_pdf(stylesheets=[stylesheet], font_config=font_config)
+    except Exception as e:
+        # e.g. a fontconfig error: every worker would fail the same way
+        conn.send(("unavailable", f"WeasyPrint warm-up failed: {type(e).__name__}: {e}", 0.0))
+        return
+    conn.send(("ready", None, 0.0))
+
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        job_id, html, output_path, base_url = job
+        start = time.perf_counter()
+        try:
+            os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+            tmp_path = f"{output_path}.tmp{os.getpid()}"
+            HTML(string=html, base_url=base_url).write_pdf(tmp_path, stylesheets=[stylesheet], font_config=font_config)
+            os.replace(tmp_path, output_path)
+            conn.send((job_id, None, time.perf_counter() - start))
+        except Exception as e:
+            conn.send((job_id, f"{type(e).__name__}: {e}", time.perf_counter() - start))
+
+
+class _Worker:
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+        self.job_id = None
+        self.started = None
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class PdfWorkerPool:
+    """
+    Long-lived PDF worker processes fed from a job queue
+
+    Args:
+        workers (int): Worker processes
+        timeout (float): Seconds a job may run before its worker is replaced
+    """
+
+    def __init__(self, workers=PDF_WORKERS, timeout=PDF_TIMEOUT):
+        # Spawned, not forked: the API process holds threads and large cached volumes
+        self._context = multiprocessing.get_context("spawn")
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._jobs = OrderedDict() # job id -> status dict
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._stopping = threading.Event()
+        self.unavailable = None # Reason PDFs cannot be rendered, set by the first worker that fails to load
+        self._warmup_failures = 0
+        self._workers = [_Worker(self._context) for _ in range(max(1, workers))]
+        self._dispatcher = threading.Thread(target=self._dispatch, name="pdf-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, html, output_path, base_url=None):
+        """
+        Queue a PDF rendering
+
+        Returns:
+            str: Job id, for job_status
+        """
+        job_id = str(next(self._ids))
+        with self._lock:
+            self._jobs[job_id] = {
+                "id": job_id, "status": "queued", "path": output_path, "error": None,
+                "submitted": time.time(), "seconds": None, "size": None,
+            }
+            self._prune()
+        if self.unavailable:
+            self._update(job_id, status="failed", error=self.unavailable)
+        else:
+            self._queue.put((job_id, html, output_path, base_url))
+        return job_id
+
+    def job_status(self, job_id):
+        """Copy of a job's status dict, or None for an unknown job"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def shutdown(self):
+        self._stopping.set()
+        self._dispatcher.join()
+        for worker in self._workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.kill()
+
+    def _prune(self):
+        finished = [id for id, job in self._jobs.items() if job["status"] in ("done", "failed")]
+        for id in finished[:max(0, len(self._jobs) - MAX_JOB_HISTORY)]:
+            del self._jobs[id]
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def _replace(self, index, error):
+        worker = self._workers[index]
+        if worker.job_id is not None:
+            self._update(worker.job_id, status="failed", error=error, seconds=time.perf_counter() - worker.started)
+        worker.kill()
+        self._workers[index] = _Worker(self._context)
+
+    def _disable(self, reason):
+        """No worker can render PDFs: fail the queued jobs and stop the workers"""
+        print(f"PDF rendering disabled: {reason}")
+        self.unavailable = reason
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self._update(job[0], status="failed", error=reason)
+        for worker in self._workers:
+            worker.kill()
+
+    def _dispatch(self):
+        while not self._stopping.is_set():
+            # Hand queued jobs to idle, warmed-up workers
+            for index, worker in enumerate(self._workers):
+                if worker.ready and worker.job_id is None:
+                    try:
+                        job = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    try:
+                        worker.conn.send(job)
+                    except OSError as e:
+                        # The worker died while idle: the job never started, so it goes back in the queue
+                        print(f"PDF worker lost before job {job[0]} ({type(e).__name__}), restarting it")
+                        self._queue.put(job)
+                        self._replace(index, None)
+                        continue
+                    worker.job_id, worker.started = job[0], time.perf_counter()
+                    self._update(job[0], status="running")
+
+            for conn in wait([worker.conn for worker in self._workers], timeout=0.1):
+                worker = next(w for w in self._workers if w.conn is conn)
+                try:
+                    job_id, error, seconds = conn.recv()
+                except (EOFError, OSError):
+                    continue # Dead worker, replaced below
+                if job_id == "ready":
+                    worker.ready = True
+                    self._warmup_failures = 0
+                    continue
+                if job_id == "unavailable":
+                    self._disable(error)
+                    return
+                if error:
+                    self._update(job_id, status="failed", error=error, seconds=seconds)
+                else:
+                    path = self.job_status(job_id)["path"]
+                    try:
+                        size = os.path.getsize(path)
+                    except OSError as e:
+                        # e.g. removed before it could be measured
+                        self._update(job_id, status="failed", error=f"PDF not found after rendering: {e}", seconds=seconds)
+                    else:
+                        print(f"PDF job {job_id}: {path} ({size / 1024:.0f} KiB) in {seconds:.2f}s")
+                        self._update(job_id, status="done", seconds=seconds, size=size)
+                worker.job_id = None
+
+            for index, worker in enumerate(self._workers):
+                if worker.job_id is not None and time.perf_counter() - worker.started > self.timeout:
+                    print(f"PDF job {worker.job_id} timed out after {self.timeout:.0f}s, restarting its worker")
+                    self._replace(index, f"Timed out after {self.timeout:.0f}s")
+                elif not worker.process.is_alive():
+                    if not worker.ready:
+                        # Died while loading (e.g. a crash in a native library), not on a job
+                        self._warmup_failures += 1
+                        if self._warmup_failures >= MAX_WARMUP_FAILURES:
+                            self._disable(f"{self._warmup_failures} PDF workers in a row exited before being ready "
+                                          f"(last exit code {worker.process.exitcode})")
+                            return
+                    print(f"PDF worker exited with code {worker.process.exitcode}, restarting it")
+                    self._replace(index, f"Worker exited with code {worker.process.exitcode}")
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """The shared pool, started on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = PdfWorkerPool()
+        return _pool
+
+
+def submit_pdf(html, output_path, base_url=None):
+    """Render a PDF in the background; returns the job id"""
+    return get_pool().submit(html, output_path, base_url)
+
+
+def job_status(job_id):
+    """Status dict of a PDF job: "status" ("queued", "running", "done", "failed"), "path", "error", "seconds", "size" """
+    return get_pool().job_status(job_id)
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
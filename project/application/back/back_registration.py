@@ -0,0 +1,253 @@
+'''
+Rigid (or affine) registration between the MRI scans of two timepoints
+
+Differences between timepoints subtract masks voxel by voxel, which only makes
+sense once both scans are aligned. The earlier (moving) scan is registered to
+the later (fixed) one:
+- starting from the alignment given by both scanner affines
+- coarse to fine on a pyramid of smoothed, downsampled volumes (1/4, 1/2)
+- maximizing the normalized cross-correlation of the two scans, evaluated at
+  once on a sample of the fixed scan's brain voxels (map_coordinates)
+- with scipy.optimize (Powell), so no gradient is needed
+
+The result is a 4x4 matrix mapping fixed voxels to moving voxels. It is
+applied with `resample` to bring masks (nearest neighbour) or images (linear)
+of the moving scan onto the fixed scan's grid, before any difference;
+`align_mask` keeps the latest aligned masks in memory.
+Transforms are cached per scan pair, in memory and as a JSON file in the fixed
+scan's folder, and recomputed when either MRI file changes.
+'''
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy.ndimage import affine_transform, gaussian_filter, map_coordinates
+from scipy.optimize import minimize
+from scipy.spatial.transform import Rotation
+
+from back_volumes import MRI_FOLDER, file_signature, load_volume, mri_path
+
+MODES = ("rigid", "affine")
+# Downscale factors, coarse to fine
+PYRAMID_FACTORS = (4, 2)
+# Fixed voxels the similarity is evaluated on, at each level
+SAMPLE_VOXELS = 40000
+# Objective evaluations per level
+MAX_EVALUATIONS = 400
+# Transforms closer than this to the identity (in voxels over the volume) are not applied
+IDENTITY_TOLERANCE = 0.05
+# Scan pairs are not registered when set to 0
+REGISTER_SCANS = os.environ.get("REGISTER_SCANS", "1") == "1"
+# Aligned masks kept in memory
+MAX_ALIGNED_MASKS = 4
+
+_transforms = {} # cache key -> transform dict
+_transforms_lock = threading.Lock()
+_aligned = OrderedDict() # (mask path, signature, matrix, shape) -> aligned mask, least recently used first
+
+
+def parameter_matrix(params, center):
+    """
+    World (mm) transform of a parameter vector, about `center`
+
+    Parameters: 3 rotations (degrees) and 3 translations (mm) for a rigid
+    transform, then 3 log-scales (%) and 3 shears (%) for an affine one.
+    """
+    params = np.asarray(params, dtype=np.float64)
+    linear = Rotation.from_euler("xyz", params[:3], degrees=True).as_matrix()
+    if len(params) > 6:
+        scale = np.diag(np.exp(params[6:9] / 100))
+        shear = np.eye(3)
+        shear[0, 1], shear[0, 2], shear[1, 2] = params[9:12] / 100
+        linear = linear @ shear @ scale
+    matrix = np.eye(4)
+    matrix[:3, :3] = linear
+    matrix[:3, 3] = center - linear @ center + params[3:6]
+    return matrix
+
+
+def voxel_matrix(params, fixed_affine, moving_affine, center):
+    """Matrix mapping fixed voxels (homogeneous) to moving voxels"""
+    return np.linalg.inv(moving_affine) @ parameter_matrix(params, center) @ fixed_affine
+
+
+def _level(data, factor):
+    """Smoothed and downsampled copy of a volume; voxel i of the level is voxel factor * i of the volume"""
+    data = np.asarray(data, dtype=np.float32)
+    return gaussian_filter(data, sigma=factor / 2)[::factor, ::factor, ::factor]
+
+
+def _sample_points(fixed_level, factor, rng):
+    """Full-resolution coordinates (3 x N) of a sample of the fixed level's brain voxels, and their values"""
+    points = np.argwhere(fixed_level > 0)
+    if len(points) < 100:
+        points = np.argwhere(np.ones(fixed_level.shape, dtype=bool))
+    if len(points) > SAMPLE_VOXELS:
+        points = points[rng.choice(len(points), SAMPLE_VOXELS, replace=False)]
+    values = fixed_level[tuple(points.T)].astype(np.float64)
+    return points.T.astype(np.float64) * factor, values
+
+
+def normalized_cross_correlation(a, b):
+    a = a - a.mean()
+    b = b - b.mean()
+    denominator = np.sqrt((a * a).sum() * (b * b).sum())
+    return float((a * b).sum() / denominator) if denominator > 0 else 0.0
+
+
+def register_volumes(fixed, moving, mode="rigid"):
+    """
+    Register a moving volume to a fixed one
+
+    Args:
+        fixed (Volume): Reference scan, e.g. the later timepoint
+        moving (Volume): Scan to align onto it
+        mode (str): "rigid" (6 parameters) or "affine" (12 parameters)
+
+    Returns:
+        dict: "matrix" (fixed voxel -> moving voxel, 4x4 list), "params", "mode" and the final "ncc"
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown registration mode '{mode}', expected one of {MODES}")
+    rng = np.random.default_rng(0)
+    fixed_affine = np.asarray(fixed.affine, dtype=np.float64)
+    moving_affine = np.asarray(moving.affine, dtype=np.float64)
+    # Rotations and scales act about the center of the fixed volume
+    center = (fixed_affine @ np.append((np.array(fixed.shape[:3]) - 1) / 2, 1))[:3]
+    params = np.zeros(6 if mode == "rigid" else 12)
+    ncc = 0.0
+
+    for factor in PYRAMID_FACTORS:
+        fixed_level = _level(fixed.data, factor)
+        moving_level = _level(moving.data, factor)
+        points, values = _sample_points(fixed_level, factor, rng)
+        homogeneous = np.vstack([points, np.ones(points.shape[1])])
+
+        def cost(p):
+            coords = (voxel_matrix(p, fixed_affine, moving_affine, center) @ homogeneous)[:3] / factor
+            sampled = map_coordinates(moving_level, coords, order=1, mode="constant", cval=0.0)
+            return -normalized_cross_correlation(values, sampled)
+
+        result = minimize(
+            cost, params, method="Powell",
+            options={"xtol": 1e-2, "ftol": 1e-5, "maxfev": MAX_EVALUATIONS},
+        )
+        params, ncc = result.x, -float(result.fun)
+
+    matrix = voxel_matrix(params, fixed_affine, moving_affine, center)
+    return {"mode": mode, "params": params.tolist(), "matrix": matrix.tolist(), "ncc": ncc}
+
+
+def is_identity(matrix, shape):
+    """Whether a voxel transform moves no voxel of the volume by more than IDENTITY_TOLERANCE"""
+    matrix = np.asarray(matrix, dtype=np.float64)
+    corners = np.array([[i, j, k, 1] for i in (0, shape[0]) for j in (0, shape[1]) for k in (0, shape[2])]).T
+    return np.abs((matrix - np.eye(4)) @ corners).max() <= IDENTITY_TOLERANCE
+
+
+def resample(data, matrix, output_shape, order=0):
+    """
+    Resample a moving volume onto the fixed grid
+
+    Args:
+        data (np.ndarray): Moving volume (e.g. a mask)
+        matrix (list): Fixed voxel -> moving voxel 4x4 matrix, from register_volumes
+        output_shape (tuple): Shape of the fixed volume
+        order (int): 0 (nearest neighbour) for masks, 1 (linear) for images
+
+    Returns:
+        np.ndarray: Volume on the fixed grid, same dtype, 0 outside the moving volume
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    if tuple(output_shape) == data.shape and is_identity(matrix, data.shape):
+        return data
+    return affine_transform(
+        np.asarray(data), matrix[:3, :3], offset=matrix[:3, 3], output_shape=tuple(output_shape),
+        order=order, mode="constant", cval=0, prefilter=False,
+    )
+
+
+def _cache_path(fixed_path, moving_path, mode):
+    key = hashlib.sha1(f"{os.path.abspath(moving_path)}\0{mode}".encode()).hexdigest()[:16]
+    return os.path.join(os.path.dirname(fixed_path), f"registration_{key}.json")
+
+
+def register_files(fixed_path, moving_path, mode="rigid"):
+    """
+    Cached registration of two MRI files, recomputed when either file changes
+
+    Returns:
+        dict: The transform, see register_volumes
+    """
+    signatures = [list(file_signature(fixed_path)), list(file_signature(moving_path))]
+    key = (os.path.abspath(fixed_path), os.path.abspath(moving_path), mode)
+    with _transforms_lock:
+        cached = _transforms.get(key)
+    if cached is not None and cached["signatures"] == signatures:
+        return cached
+
+    path = _cache_path(fixed_path, moving_path, mode)
+    transform = None
+    try:
+        with open(path, "r") as f:
+            transform = json.load(f)
+        if transform.get("signatures") != signatures:
+            transform = None
+    except (OSError, ValueError):
+        pass
+
+    if transform is None:
+        transform = register_volumes(load_volume(fixed_path), load_volume(moving_path), mode)
+        transform["signatures"] = signatures
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(transform, f)
+        os.replace(tmp_path, path)
+
+    with _transforms_lock:
+        _transforms[key] = transform
+    return transform
+
+
+def register_scans(fixed_id, moving_id, mri_folder=MRI_FOLDER, mode="rigid"):
+    """Cached transform bringing scan `moving_id` onto scan `fixed_id`, or None when registration is disabled"""
+    if not REGISTER_SCANS:
+        return None
+    return register_files(mri_path(fixed_id, mri_folder), mri_path(moving_id, mri_folder), mode)
+
+
+def align_mask(mask, transform, output_shape):
+    """
+    Mask of the moving scan on the fixed scan's grid, cached for the latest few masks and transforms
+
+    Args:
+        mask (Volume): Cached mask of the moving scan (back_volumes.py)
+        transform (dict, optional): From register_scans; None leaves the mask as is
+        output_shape (tuple): Shape of the fixed scan
+
+    Returns:
+        np.ndarray: Read-only aligned mask, the mask itself when the transform is the identity
+    """
+    if transform is None:
+        return mask.data
+    matrix = np.asarray(transform["matrix"], dtype=np.float64)
+    key = (os.path.abspath(mask.path), file_signature(mask.path), matrix.tobytes(), tuple(output_shape))
+    with _transforms_lock:
+        aligned = _aligned.get(key)
+        if aligned is not None:
+            _aligned.move_to_end(key)
+            return aligned
+    aligned = resample(mask.data, matrix, output_shape, order=0)
+    if aligned is mask.data:
+        # Already aligned
+        return aligned
+    aligned.flags.writeable = False
+    with _transforms_lock:
+        _aligned[key] = aligned
+        while len(_aligned) > MAX_ALIGNED_MASKS:
+            _aligned.popitem(last=False)
+    return aligned
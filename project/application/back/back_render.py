@@ -0,0 +1,278 @@
+'''
+Code to render MRI volumes and segmentation overlays as image stacks for the viewer
+
+Stacks of slices are processed at once with numpy. Each slice along the first
+axis is min-max normalized on its own, as the viewer always did. Overlays paint
+mask voxels in a solid color. Stacks are uint8 in OpenCV's BGR channel order,
+ready for cv2.imencode / cv2.imwrite.
+
+Series are sliced along the stored first axis by default, or along the axial,
+coronal or sagittal axis found from the affine (see oriented_view). Encoded
+slices can be streamed slab by slab (iter_encoded_slices, or write_slices to
+files) so memory stays bounded by one slab instead of the whole rendered stack.
+'''
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import nibabel as nib
+import numpy as np
+
+# Overlay colors, BGR
+RED = (0, 0, 255)
+
+SLICE_NAME = "slice_{:03d}.jpg"
+# cv2.imwrite's default quality
+JPEG_QUALITY = 95
+# OpenCV releases the GIL while encoding, so threads encode in parallel
+ENCODE_WORKERS = min(8, os.cpu_count() or 1)
+# Resolution levels: downscale factor of each level. Full resolution slices stay in the
+# series folder, the other levels go to a subfolder named after the level
+PYRAMID_LEVELS = {"full": 1, "half": 2, "thumb": 4}
+ORIENTATIONS = ("axial", "coronal", "sagittal")
+# Orientation -> (flip of each RAS axis, RAS axis of each view axis) of the display orientation
+ORIENTED_AXES = {
+    "axial": ((True, True, False), (2, 1, 0)),
+    "coronal": ((True, False, True), (1, 2, 0)),
+    "sagittal": ((False, True, True), (0, 2, 1)),
+}
+# Render modes: the MRI alone, with a mask on top, with the change between two masks on top
+MODES = ("raw", "overlay", "difference")
+# Slices rendered and encoded at a time when streaming
+SLAB_SLICES = 16
+
+
+def oriented_view(data, affine, orientation=None):
+    """
+    View of a volume with the slices of an anatomical orientation along the first axis (no copy)
+
+    Slices are in radiological display orientation: axial and coronal slices show
+    the patient's right on the image's left, superior (or anterior for axial) at
+    the top; sagittal slices show anterior on the left, superior at the top.
+
+    Args:
+        data (np.ndarray): Volume in its stored voxel order
+        affine (np.ndarray): Voxel to world (RAS) affine of the volume
+        orientation (str, optional): "axial", "coronal" or "sagittal"; None keeps the stored first axis
+
+    Returns:
+        np.ndarray: View of `data`, slices along the first axis
+    """
+    if orientation is None:
+        return data
+    if orientation not in ORIENTATIONS:
+        raise ValueError(f"Unknown orientation '{orientation}', expected one of {ORIENTATIONS}")
+    # Flips and transposes only: a view in RAS voxel order, x to the right, y anterior, z superior
+    ras = nib.orientations.apply_orientation(data, nib.orientations.io_orientation(affine))
+    flips, axes = ORIENTED_AXES[orientation]
+    return ras[tuple(slice(None, None, -1) if flip else slice(None) for flip in flips)].transpose(axes)
+
+
+def oriented_matrix(affine, shape, orientation=None):
+    """
+    Voxel matrix of oriented_view: maps (homogeneous) indices of the view to indices of the stored volume
+
+    `affine @ oriented_matrix(...)` is the voxel to world affine of the view.
+
+    Args:
+        affine (np.ndarray): Voxel to world (RAS) affine of the volume
+        shape (tuple): Stored shape of the volume
+        orientation (str, optional): As for oriented_view
+
+    Returns:
+        np.ndarray: 4x4 matrix
+    """
+    if orientation is None:
+        return np.eye(4)
+    ornt = nib.orientations.io_orientation(affine)
+    ras_shape = np.empty(3, dtype=np.int64)
+    ras_shape[ornt[:, 0].astype(int)] = shape[:3]
+    flips, axes = ORIENTED_AXES[orientation]
+    # View index -> RAS index: axis `a` of the view is RAS axis axes[a], flipped or not
+    to_ras = np.eye(4)
+    to_ras[:3, :3] = 0
+    for a, r in enumerate(axes):
+        to_ras[r, a] = -1 if flips[r] else 1
+        to_ras[r, 3] = ras_shape[r] - 1 if flips[r] else 0
+    return nib.orientations.inv_ornt_aff(ornt, shape[:3]) @ to_ras
+
+
+def normalize_slices(volume):
+    """
+    Min-max normalize every slice (along the first axis) of a volume to uint8, in one pass
+
+    Args:
+        volume (np.ndarray): Volume of any shape and numeric dtype, slices along axis 0
+
+    Returns:
+        np.ndarray: uint8 volume of the same shape; constant slices are black
+    """
+    volume = np.asarray(volume, dtype=np.float32)
+    reduce_axes = tuple(range(1, volume.ndim))
+    min_val = volume.min(axis=reduce_axes, keepdims=True)
+    value_range = volume.max(axis=reduce_axes, keepdims=True) - min_val
+    scale = np.divide(255, value_range, out=np.zeros_like(value_range), where=value_range > 0)
+    gray = volume - min_val
+    gray *= scale
+    return gray.astype(np.uint8)
+
+
+def gray_to_bgr(gray):
+    """uint8 gray stack (n, h, w) -> uint8 BGR stack (n, h, w, 3)"""
+    return np.stack([gray] * 3, axis=-1)
+
+
+def overlay(gray, mask, color=RED):
+    """
+    Paint the voxels of `mask` on top of a normalized gray stack
+
+    Args:
+        gray (np.ndarray): uint8 stack from normalize_slices
+        mask (np.ndarray): Boolean or label volume of the same shape, painted where > 0
+        color (tuple): BGR color of the overlay
+
+    Returns:
+        np.ndarray: uint8 BGR stack (n, h, w, 3)
+    """
+    if mask.shape != gray.shape:
+        raise ValueError(f"Mask shape {mask.shape} does not match volume shape {gray.shape}")
+    image = gray_to_bgr(gray)
+    image[mask > 0] = color
+    return image
+
+
+def render_stack(volume, masks=(), mode="raw", indices=None, color=RED):
+    """
+    Render slices of a volume
+
+    Args:
+        volume (np.ndarray): Volume (or oriented view), slices along axis 0
+        masks (list): No mask for "raw", the mask for "overlay", [after, before] masks for "difference",
+                      with the same shape as the volume
+        mode (str): "raw", "overlay" or "difference"
+        indices (array-like, optional): Slices to render, all by default
+        color (tuple): BGR color of the overlay
+
+    Returns:
+        np.ndarray: uint8 gray stack for "raw", uint8 BGR stack otherwise
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode '{mode}', expected one of {MODES}")
+    select = slice(None) if indices is None else np.asarray(indices)
+    gray = normalize_slices(volume[select])
+    if mode == "raw":
+        return gray
+    mask = masks[0][select]
+    if mode == "difference":
+        mask = mask != masks[1][select]
+    return overlay(gray, mask, color)
+
+
+def downscale(stack, factor):
+    """
+    Downscale every slice of a rendered stack by an integer factor (area averaging)
+
+    Args:
+        stack (np.ndarray): uint8 stack (n, h, w) or (n, h, w, 3)
+        factor (int): Downscale factor, 1 returns the stack itself
+
+    Returns:
+        np.ndarray: uint8 stack (n, round(h / factor), round(w / factor)[, 3])
+    """
+    if factor == 1:
+        return stack
+    h, w = stack.shape[1:3]
+    size = (max(1, round(w / factor)), max(1, round(h / factor)))
+    out = np.empty((len(stack), size[1], size[0]) + stack.shape[3:], dtype=np.uint8)
+    for i, image in enumerate(stack):
+        out[i] = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return out
+
+
+def pyramid(stack, levels=PYRAMID_LEVELS):
+    """Every resolution level of a rendered stack, as a dict level -> stack"""
+    return {level: downscale(stack, levels[level]) for level in levels}
+
+
+def level_folder(folder, level):
+    """Folder holding the slices of a resolution level"""
+    return folder if PYRAMID_LEVELS[level] == 1 else os.path.join(folder, level)
+
+
+def encode_jpeg(image, quality=JPEG_QUALITY):
+    """Encode one gray or BGR slice as JPEG bytes"""
+    ok, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise RuntimeError("JPEG encoding failed")
+    return buffer.tobytes()
+
+
+def iter_encoded_slices(volume, masks=(), mode="raw", indices=None, levels=PYRAMID_LEVELS,
+                        slab=SLAB_SLICES, workers=ENCODE_WORKERS, quality=JPEG_QUALITY):
+    """
+    Render and encode slices one slab at a time, yielding the JPEGs in slice order
+
+    Only one slab is rendered and held in memory at a time; its slices (at every level)
+    are encoded in parallel.
+
+    Args:
+        volume, masks, mode, indices: As for render_stack
+        levels (dict): Resolution levels to encode, level -> downscale factor
+        slab (int): Slices rendered at a time
+        workers (int): Encoding threads
+        quality (int): JPEG quality
+
+    Yields:
+        tuple: (slice index, level, JPEG bytes)
+    """
+    indices = list(range(volume.shape[0]) if indices is None else indices)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(indices), slab):
+            chunk = indices[start:start + slab]
+            stacks = pyramid(render_stack(volume, masks, mode, chunk), levels)
+            jobs = [(index, level, image) for level, stack in stacks.items() for index, image in zip(chunk, stack)]
+            encoded = executor.map(lambda job: encode_jpeg(job[2], quality), jobs)
+            for (index, level, _), data in zip(jobs, encoded):
+                yield int(index), level, data
+
+
+def write_atomic(path, data):
+    """Write through a temporary file and rename it, so readers never see a half-written file"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def write_slices(volume, path_of, masks=(), mode="raw", indices=None, levels=PYRAMID_LEVELS,
+                 slab=SLAB_SLICES, workers=ENCODE_WORKERS, quality=JPEG_QUALITY):
+    """
+    Stream slices from iter_encoded_slices and write them as JPEG files on a thread pool
+
+    Writes overlap with the encoding of the next slices; at most one slab of encoded
+    slices (at every level) waits to be written.
+
+    Args:
+        volume, masks, mode, indices, levels, slab, quality: As for iter_encoded_slices
+        path_of (callable): (slice index, level) -> output path; the folders must exist
+        workers (int): Encoding threads, and as many writing threads
+
+    Returns:
+        int: Number of files written
+    """
+    written = 0
+    pending = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for index, level, data in iter_encoded_slices(volume, masks, mode, indices, levels, slab, workers, quality):
+            pending.append(executor.submit(write_atomic, path_of(index, level), data))
+            if len(pending) >= slab * len(levels):
+                # result() re-raises the first write error
+                for future in pending:
+                    future.result()
+                written += len(pending)
+                pending = []
+        for future in pending:
+            future.result()
+    return written + len(pending)
@@ -1,11 +1,18 @@
+import base64
 import json
-import numpy as np
-import nibabel as nb
-from scipy.ndimage import label
-from scipy.ndimage import center_of_mass, distance_transform_edt
+import time
 import cv2
 import os
 from back_irm_analysis import run_analysis_location, run_analysis
+from back_charts import line_chart_svg
+from back_pdf import PDF_CSS
+from back_lesions import analyze_lesions, biggest_difference_slice
+from back_registration import align_mask, register_scans
+from back_tracking import track_lesions, tracking_summary
+from back_timeline import TREND_SCANS, record_scan, scan_date, scan_key, trend
+from back_volumes import load_seg
+from back_render import SLICE_NAME, level_folder
+from back_slices import render_slice_image
 
 try:
     from weasyprint import HTML, CSS
@@ -17,6 +24,14 @@ except (ImportError, OSError) as e:
 
 MRI_FOLDER = "./front/public/mri"
 REPORT_FOLDER = "./front/public/report"
+# Lesions (or changes) listed one by one in the report, largest first
+MAX_REPORTED_LESIONS = 20
+# Embedded images: a third of the A4 text width, at print resolution
+REPORT_IMAGE_WIDTH_CM = 6
+PRINT_DPI = 150
+REPORT_JPEG_QUALITY = 85
+# Template image -> (series, kind) of the slice endpoint
+REPORT_IMAGES = {"img_tp0": ("0", "seg"), "img_tp1": ("1", "seg"), "difference": ("1", "difference")}
 
 REPORT_TEMPLATE = """<!DOCTYPE html>
 <html>
@@ -171,7 +186,6 @@ REPORT_TEMPLATE = """<!DOCTYPE html>
         
         .chart-container {{
             position: relative;
-            height: 420px;
             width: 100%;
             padding: 0;
             box-sizing: border-box;
@@ -211,7 +225,6 @@ REPORT_TEMPLATE = """<!DOCTYPE html>
             font-weight: 600;
         }}
     </style>
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/Chart.js/3.9.1/chart.min.js"></script>
 </head>
 <body>
     <h1>ARIA-E Monitoring</h1>
@@ -267,6 +280,8 @@ REPORT_TEMPLATE = """<!DOCTYPE html>
                 <h4>Sites of Involvement</h4>
                 <div class="metric-value">{num_lesions_tp1}</div>
                 <div class="metric-change positive">({num_lesions_diff:+d})</div>
+                <div class="metric-change">{new_sites} new, {growing_sites} growing, {resolved_sites} resolved</div>
+                {uncertainty_note}
             </div>
             <div class="metric-card">
                 <h4>Radiographic Grading</h4>
@@ -278,139 +293,169 @@ REPORT_TEMPLATE = """<!DOCTYPE html>
     <div class="chart-section">
         <div class="chart-title">Volumes Evolution</div>
         <div class="chart-container">
-            <canvas id="evolutionChart"></canvas>
+            {trend_chart}
         </div>
     </div>
 
-    <script>
-        const ctx = document.getElementById('evolutionChart').getContext('2d');
-        const chart = new Chart(ctx, {{
-            type: 'line',
-            data: {{
-                labels: ['{date_previous}', '{date_tp0}', '{date_tp1}'],
-                datasets: [{{
-                    label: 'Max Diameter (cm)',
-                    data: [{previous_diameter:.2f}, {tp0_diameter:.2f}, {tp1_diameter:.2f}],
-                    borderColor: '#3498db',
-                    backgroundColor: 'transparent',
-                    borderWidth: 3,
-                    pointBackgroundColor: '#3498db',
-                    pointBorderColor: '#fff',
-                    pointBorderWidth: 2,
-                    pointRadius: 6,
-                    fill: false,
-                    tension: 0.3
-                }}]
-            }},
-            options: {{
-                responsive: true,
-                maintainAspectRatio: true,
-                aspectRatio: 2.5,
-                layout: {{
-                    padding: 0
-                }},
-                plugins: {{
-                    legend: {{
-                        display: false
-                    }}
-                }},
-                scales: {{
-                    y: {{
-                        beginAtZero: false,
-                        title: {{
-                            display: true,
-                            text: 'Diameter (cm)',
-                            font: {{
-                                weight: 'bold'
-                            }}
-                        }},
-                        grid: {{
-                            color: 'rgba(0,0,0,0.05)'
-                        }}
-                    }},
-                    x: {{
-                        title: {{
-                            display: true,
-                            text: 'Scan Date',
-                            font: {{
-                                weight: 'bold'
-                            }}
-                        }},
-                        grid: {{
-                            color: 'rgba(0,0,0,0.05)'
-                        }}
-                    }}
-                }}
-            }}
-        }});
-    </script>
 </body>
 </html>
 """
 
-PIXEL_AREA_ON_MRI = 0.004 # in cm^2
-DISTANCE_BETWEEN_SLICES = 0.1 # in cm
-
-def compute_volume(segmentation):
-    num_voxels = np.sum(segmentation > 0)
-    voxel_volume = PIXEL_AREA_ON_MRI * DISTANCE_BETWEEN_SLICES
-    return num_voxels * voxel_volume
-
-def compute_number_of_oedemas(segmentation):
-    _, num_features = label(segmentation > 0)
-    return num_features
+def slice_url(series_folder, index, level="full"):
+    """
+    Public URL of a slice written by the extraction (front/public/mri/slice.py)
 
-def compute_max_diameter(segmentation):
-    coords = np.argwhere(segmentation > 0)
-    if coords.size == 0:
-        return 0.0 
+    Args:
+        series_folder (str): Series folder in the MRI folder, e.g. "0.seg" or "difference"
+        index (int): Slice index along the stored first axis
+        level (str): Resolution level, "full", "half" or "thumb"
+    """
+    return "/mri/" + level_folder(series_folder, level) + "/" + SLICE_NAME.format(int(index))
 
-    com = center_of_mass(segmentation)
+def slice_data_uri(series, kind, index, width_cm=REPORT_IMAGE_WIDTH_CM, dpi=PRINT_DPI, quality=REPORT_JPEG_QUALITY):
+    """
+    Slice as an inline JPEG data URI, so the report needs no server and no base URL
 
-    dist_transform = distance_transform_edt(segmentation > 0)
+    The slice is rendered at full resolution, downscaled only if it has more
+    pixels than the printed width needs, and encoded once as an optimized JPEG.
 
-    max_distance = np.max(dist_transform[tuple(coords.T)])
-    
-    return max_distance * 2 * PIXEL_AREA_ON_MRI**0.5
+    Args:
+        series (str): Scan folder name, e.g. "1"
+        kind (str): "raw", "seg" or "difference"
+        index (int): Slice index along the stored first axis
+        width_cm (float): Printed width of the image
+        dpi (int): Print resolution
+        quality (int): JPEG quality
 
-def find_biggest_difference_slice(segmentation_t0, segmentation_t1):
-    diff = np.abs(segmentation_t1 - segmentation_t0)
-    max_diff_index = np.argmax(np.sum(diff, axis=(1, 2)))
-    return max_diff_index
+    Returns:
+        str: data:image/jpeg;base64,... URI
+    """
+    image = render_slice_image(series, kind, int(index))[0]
+    width = int(round(width_cm / 2.54 * dpi))
+    if image.shape[1] > width:
+        height = int(round(image.shape[0] * width / image.shape[1]))
+        image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    ok, jpeg = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, 1])
+    if not ok:
+        raise ValueError(f"Could not encode slice {index} of {series}/{kind}")
+    return "data:image/jpeg;base64," + base64.b64encode(jpeg.tobytes()).decode("ascii")
+
+def report_images(index, embed=True):
+    """Sources of the report's three images: inline data URIs, or URLs of the extracted slices"""
+    if not embed:
+        return {
+            "img_tp0": slice_url("0.seg", index),
+            "img_tp1": slice_url("1.seg", index),
+            "difference": slice_url("difference", index),
+        }
+    return {name: slice_data_uri(series, kind, index) for name, (series, kind) in REPORT_IMAGES.items()}
+
+def load_lesion_uncertainty(id):
+    """
+    Per-lesion uncertainty returned by the segmentation endpoint for MRI `id`, or None if not available
+    """
+    path = f"{MRI_FOLDER}/{id}.seg/lesion_uncertainty.json"
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
 
 def generate_client_report(client_name):
     info = {
         "client_name": client_name,
-        "time0": "2025-03-24",
-        "time1": "2025-04-18",
+        "time0": scan_date("0", MRI_FOLDER),
+        "time1": scan_date("1", MRI_FOLDER),
         "rmi_location": run_analysis_location(1),
     }
 
-    seg_t0_slices = nb.load("./front/public/mri/0.seg/mri_file.nii").get_fdata()
-    seg_t1_slices = nb.load("./front/public/mri/1.seg/mri_file.nii").get_fdata()
+    # Shared with the slice rendering and the MRI analysis, read once per file version
+    # Each mask is labelled once; every metric comes from that pass
+    seg_t0 = load_seg("0", MRI_FOLDER)
+    seg_t1 = load_seg("1", MRI_FOLDER)
+    # Volumes and diameters use the voxel spacing of each scan's header
+    lesions_t0 = analyze_lesions(seg_t0.data, seg_t0.geometry)
+    lesions_t1 = analyze_lesions(seg_t1.data, seg_t1.geometry)
+
+    # Changes are measured once scan 0 is aligned onto scan 1 (nothing moves when both are already aligned)
+    aligned_t0 = align_mask(seg_t0, register_scans("1", "0", MRI_FOLDER), seg_t1.shape)
+    aligned_lesions_t0 = lesions_t0 if aligned_t0 is seg_t0.data else analyze_lesions(aligned_t0, seg_t1.geometry)
 
-    volume_t0 = float(compute_volume(seg_t0_slices))
-    volume_t1 = float(compute_volume(seg_t1_slices))
+    volume_t0 = float(lesions_t0.volume)
+    volume_t1 = float(lesions_t1.volume)
     volume_change = volume_t1 - volume_t0
-    biggest_diff_slice = int(find_biggest_difference_slice(seg_t0_slices, seg_t1_slices))
-    info["biggest_diff_slice"] = biggest_diff_slice
+    info["biggest_diff_slice"] = biggest_difference_slice(aligned_lesions_t0, lesions_t1)
     info["volume_t0"] = volume_t0
     info["volume_t1"] = volume_t1
     info["volume_change"] = volume_change
-    info["oedemas_t0"] = float(compute_number_of_oedemas(seg_t0_slices))
-    info["oedemas_t1"] = float(compute_number_of_oedemas(seg_t1_slices))
-    info["max_diameter_t0"] = float(compute_max_diameter(seg_t0_slices))
-    info["max_diameter_t1"] = float(compute_max_diameter(seg_t1_slices))
-
+    info["oedemas_t0"] = float(lesions_t0.count)
+    info["oedemas_t1"] = float(lesions_t1.count)
+    info["max_diameter_t0"] = float(lesions_t0.max_diameter)
+    info["max_diameter_t1"] = float(lesions_t1.max_diameter)
+    # Maximum Feret diameter of each site of involvement, the size the ARIA-E grading uses
+    info["lesion_diameters_t1"] = sorted((lesion.max_diameter for lesion in lesions_t1.lesions), reverse=True)[:MAX_REPORTED_LESIONS]
+
+    # Sites followed from t0 to t1: new, resolved, growing, shrinking or stable
+    tracks = track_lesions(aligned_lesions_t0, lesions_t1)
+    info["lesion_tracking"] = tracking_summary(tracks)
+    largest_changes = sorted(tracks, key=lambda track: abs(track.volume_change), reverse=True)[:MAX_REPORTED_LESIONS]
+    info["lesion_changes"] = [track.to_dict() for track in largest_changes]
+
+    # Lesions on which the mirrored segmentation passes disagree
+    for id in ("0", "1"):
+        lesion_uncertainty = load_lesion_uncertainty(id)
+        if lesion_uncertainty is not None:
+            info[f"low_confidence_lesions_t{id}"] = sum(1 for lesion in lesion_uncertainty if lesion["low_confidence"])
+
+    # History of the patient: both scans are recorded, earlier ones come from the timeline store
+    # Scans are keyed by their MRI content, so two scans sharing a date are both kept
+    key_t0, key_t1 = scan_key("0", MRI_FOLDER), scan_key("1", MRI_FOLDER)
+    if info["time0"] == info["time1"] and key_t0 != key_t1:
+        print(f"Both scans are dated {info['time1']}; add a scan.json with their acquisition dates")
+    record_scan(client_name, key_t0, info["time0"], lesions_t0, source=seg_t0.path)
+    record_scan(client_name, key_t1, info["time1"], lesions_t1, source=seg_t1.path)
+    info["timeline"] = trend(client_name, TREND_SCANS, until=info["time1"])
     info["previous_volumes"] = {
-        "2025-02-27": float(volume_t0 - (volume_change / 2)),
+        scan["date"]: scan["volume"] for scan in info["timeline"]
+        if scan["scan"] not in (key_t0, key_t1) and scan["date"] <= info["time0"]
     }
 
-    info["severity"], info["severity_reason"] = run_analysis(1)
+    info["severity"], info["severity_reason"] = run_analysis(json.dumps(info))
 
     return info
 
-def generate_html(info_json):
+def uncertainty_note(info_json):
+    """
+    Note on the lesions the mirrored segmentation passes disagree on, for the sites card
+
+    Args:
+        info_json (dict): Report data, from generate_client_report
+
+    Returns:
+        str: HTML line, empty when the segmentation came without an uncertainty map
+    """
+    low_confidence = info_json.get("low_confidence_lesions_t1")
+    if low_confidence is None:
+        return ""
+    if low_confidence == 0:
+        return '<div class="metric-change">All sites segmented with high confidence</div>'
+    plural = "s" if low_confidence > 1 else ""
+    return (f'<div class="metric-change negative">{low_confidence} low-confidence site{plural}, '
+            f'review the segmentation before grading</div>')
+
+def generate_html(info_json, embed_images=True):
+    """
+    Render the HTML report
+
+    Args:
+        info_json (dict): Report data, from generate_client_report
+        embed_images (bool): Embed the images as data URIs (self-contained HTML, no base URL needed
+                             for the PDF); otherwise link the extracted slices under /mri
+
+    Returns:
+        str: The HTML document
+    """
+    start = time.perf_counter()
+    images = report_images(info_json["biggest_diff_slice"], embed_images)
     out = REPORT_TEMPLATE.format(
         patient_name=info_json["client_name"],
         referring_md="Dr. Roger",
@@ -418,21 +463,28 @@ def generate_html(info_json):
         patient_id="123456789",
         date_tp1=info_json["time1"],
         date_tp0=info_json["time0"],
-        date_previous=list(info_json["previous_volumes"].keys())[0],
-        img_tp0=f"/mri/0.seg/slice_{str(info_json['biggest_diff_slice']).zfill(3)}.jpg",
-        img_tp1=f"/mri/1.seg/slice_{str(info_json['biggest_diff_slice']).zfill(3)}.jpg",
-        difference=f"/mri/difference/slice_{str(info_json['biggest_diff_slice']).zfill(3)}.jpg",
+        date_previous=info_json["timeline"][0]["date"],
+        **images,
         diameter=info_json["max_diameter_t1"],
         diameter_change=info_json["max_diameter_t1"] - info_json["max_diameter_t0"],
         total_volume=info_json["volume_t1"],
         total_volume_change=info_json["volume_change"],
         num_lesions_tp1=int(info_json["oedemas_t1"]),
         num_lesions_diff=int(info_json["oedemas_t1"] - info_json["oedemas_t0"]),
+        new_sites=info_json["lesion_tracking"]["new"],
+        growing_sites=info_json["lesion_tracking"]["growing"],
+        resolved_sites=info_json["lesion_tracking"]["resolved"],
+        uncertainty_note=uncertainty_note(info_json),
         radiographic_grading=info_json["severity"],
-        previous_diameter=info_json["max_diameter_t0"],
-        tp0_diameter=info_json["max_diameter_t0"],
-        tp1_diameter=info_json["max_diameter_t1"]
+        trend_chart=line_chart_svg(
+            [scan["date"] for scan in info_json["timeline"]],
+            [round(scan["max_diameter"], 2) for scan in info_json["timeline"]],
+            y_title="Diameter (cm)", x_title="Scan Date",
+        ),
     )
+    image_bytes = sum(len(src) for src in images.values()) if embed_images else 0
+    print(f"Report HTML: {len(out) / 1024:.0f} KiB ({image_bytes / 1024:.0f} KiB of embedded images) "
+          f"in {time.perf_counter() - start:.2f}s")
     return out
 
 # HTML and JSON ##################
@@ -488,34 +540,8 @@ def generate_pdf_from_html(html_content, output_path=None):
         # Create HTML document from string
         html_doc = HTML(string=html_content)
         
-        # Optional: Add custom CSS for better PDF formatting
-        pdf_css = CSS(string="""
-            @page {
-                size: A4;
-                margin: 1cm;
-            }
-            
-            /* Ensure images fit on page */
-            .visualization img {
-                max-width: 100%;
-                height: auto;
-            }
-            
-            /* Better chart rendering for PDF */
-            .chart-container {
-                page-break-inside: avoid;
-            }
-            
-            /* Prevent page breaks inside metric cards */
-            .metric-card {
-                page-break-inside: avoid;
-            }
-            
-            /* Header cards page break control */
-            .header-cards {
-                page-break-inside: avoid;
-            }
-        """)
+        # Same stylesheet as the background PDF workers
+        pdf_css = CSS(string=PDF_CSS)
         
         # Generate PDF
         html_doc.write_pdf(output_path, stylesheets=[pdf_css])
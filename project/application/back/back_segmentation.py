@@ -21,7 +21,7 @@ def run_segmentation(id):
     from pathlib import Path
     application_dir = Path(__file__).parent.parent
     input_file = str(application_dir / "front" / "public" / "mri" / id / "mri_file.nii")
-    output_file = str(application_dir / "front" / "public" / "mri" / f"{id}.seg" / "mri_file.nii")
+    output_file = str(application_dir / "front" / "public" / "mri" / f"{id}.seg" / "mri_file.rle")
     
     # Ensure output directory exists
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
@@ -35,7 +35,9 @@ def run_segmentation(id):
         "python", 
         script_path,
         "--input_file", input_file,
-        "--output_file", output_file
+        "--output_file", output_file,
+        "--output_format", "rle",
+        "--uncertainty"
     ]
     
     try:
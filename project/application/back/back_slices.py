@@ -0,0 +1,172 @@
+'''
+Code to render single viewer slices on demand, for the GET /mri/{series}/{kind}/{index} endpoint
+
+A series is a scan folder of the MRI folder ("0", "1"). Kinds are:
+- raw: the normalized MRI slice
+- seg: the slice with its segmentation in red on top
+- difference: the slice with the voxels whose segmentation changed since the previous series in red,
+  the previous segmentation being first aligned with the registration of both scans (back_registration.py)
+
+Slices can be requested at any resolution level of the pyramid and along the
+stored first axis or an anatomical orientation (back_render.py).
+Volumes come from the shared volume cache (back_volumes.py), so only the
+requested slice of a memory-mapped MRI is read. Encoded JPEGs are kept in an
+LRU cache bounded in bytes.
+'''
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from back_mask import find_mask
+from back_registration import REGISTER_SCANS, align_mask, register_files
+from back_render import JPEG_QUALITY, PYRAMID_LEVELS, downscale, encode_jpeg, oriented_view, render_stack
+from back_volumes import file_signature, load_mask_volume, load_volume
+
+MRI_FOLDER = "./front/public/mri"
+
+KINDS = ("raw", "seg", "difference")
+# Render mode of each kind (see back_render.py)
+KIND_MODES = {"raw": "raw", "seg": "overlay", "difference": "difference"}
+# Budget of the encoded slice cache; a 240x240 slice is 10-30 KB
+SLICE_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class ByteLRUCache:
+    """Thread-safe LRU cache of bytes values, bounded by the total size of the values"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def __len__(self):
+        return len(self._items)
+
+
+slice_cache = ByteLRUCache(SLICE_CACHE_BYTES)
+
+
+def mri_path(series):
+    return os.path.join(MRI_FOLDER, series, "mri_file.nii")
+
+
+def seg_path(series):
+    path = find_mask(os.path.join(MRI_FOLDER, f"{series}.seg"))
+    if path is None:
+        raise FileNotFoundError(f"No segmentation for series {series}")
+    return path
+
+
+def previous_series(series):
+    """The series a difference is computed against: "1" -> "0" """
+    if not series.isdigit() or int(series) == 0:
+        raise ValueError(f"Series {series} has no previous series to compare with")
+    return str(int(series) - 1)
+
+
+def source_files(series, kind):
+    """Files a rendered slice depends on: the MRI, then masks, then for a difference the previous MRI"""
+    if not series.isdigit():
+        raise ValueError(f"Invalid series '{series}'")
+    if kind not in KINDS:
+        raise ValueError(f"Unknown kind '{kind}', expected one of {KINDS}")
+    if kind == "raw":
+        return [mri_path(series)]
+    if kind == "seg":
+        return [mri_path(series), seg_path(series)]
+    previous = previous_series(series)
+    return [mri_path(series), seg_path(series), seg_path(previous), mri_path(previous)]
+
+
+def slice_etag(series, kind, index, level="full", orientation=None):
+    """ETag of a slice: changes whenever one of its source files changes"""
+    if level not in PYRAMID_LEVELS:
+        raise ValueError(f"Unknown level '{level}', expected one of {list(PYRAMID_LEVELS)}")
+    parts = [series, kind, str(index), level, str(orientation), str(JPEG_QUALITY), str(REGISTER_SCANS)]
+    for path in source_files(series, kind):
+        parts += [path, *map(str, file_signature(path))]
+    return hashlib.sha1("\0".join(parts).encode()).hexdigest()
+
+
+def render_slice_image(series, kind, index, orientation=None):
+    """
+    Render one full resolution slice
+
+    Args:
+        series (str): Scan folder name, e.g. "0"
+        kind (str): "raw", "seg" or "difference"
+        index (int): Slice index along the first axis
+        orientation (str, optional): "axial", "coronal" or "sagittal"; None slices along the stored first axis
+
+    Returns:
+        np.ndarray: Stack of the one uint8 slice, gray for "raw" and BGR otherwise
+    """
+    paths = source_files(series, kind)
+    mri = load_volume(paths[0])
+    volume = oriented_view(mri.data, mri.affine, orientation)
+    if not 0 <= index < volume.shape[0]:
+        raise IndexError(f"Slice {index} out of range, series {series} has {volume.shape[0]} slices")
+
+    masks = [load_mask_volume(path).data for path in paths[1:3]]
+    if kind == "difference":
+        # Previous segmentation on the grid of this series
+        transform = register_files(paths[0], paths[3]) if REGISTER_SCANS else None
+        masks[1] = align_mask(load_mask_volume(paths[2]), transform, mri.shape)
+    masks = [oriented_view(mask, mri.affine, orientation) for mask in masks]
+    return render_stack(volume, masks, KIND_MODES[kind], [index])
+
+
+def render_slice(series, kind, index, level="full", orientation=None):
+    """
+    Render one slice as JPEG bytes
+
+    Args:
+        series (str): Scan folder name, e.g. "0"
+        kind (str): "raw", "seg" or "difference"
+        index (int): Slice index along the first axis
+        level (str): Resolution level, "full", "half" or "thumb"
+        orientation (str, optional): "axial", "coronal" or "sagittal"; None slices along the stored first axis
+
+    Returns:
+        bytes: The encoded JPEG
+    """
+    image = render_slice_image(series, kind, index, orientation)
+    return encode_jpeg(downscale(image, PYRAMID_LEVELS[level])[0])
+
+
+def get_slice(series, kind, index, level="full", orientation=None):
+    """
+    Get one encoded slice, from the cache or freshly rendered
+
+    Returns:
+        tuple: (JPEG bytes, ETag)
+    """
+    etag = slice_etag(series, kind, index, level, orientation)
+    data = slice_cache.get(etag)
+    if data is None:
+        data = render_slice(series, kind, index, level, orientation)
+        slice_cache.put(etag, data)
+    return data, etag
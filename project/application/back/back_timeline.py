@@ -0,0 +1,171 @@
+'''
+Longitudinal store of the lesion metrics of every scan of a patient
+
+Metrics are recorded in a local SQLite database when a scan is analyzed:
+- scans: one row per (patient, scan) with the date and totals of the scan
+- lesions: one row per lesion of a scan with its own measurements
+
+A scan is identified by the content hash of its MRI file, not by its date:
+two scans can share a date (e.g. both dated from MRI files copied the same
+day), and recording one must never replace the other. Recording the same
+scan again (e.g. after a new segmentation) replaces its metrics.
+
+Reports read the history of a patient from here instead of reloading old
+volumes: the trend over the last N scans is one query on the
+(patient, date) index.
+
+The date of a scan is read from the optional scan.json of its MRI folder
+({"date": "YYYY-MM-DD"}), or else taken from the modification date of its
+MRI file.
+'''
+
+import datetime
+import json
+import os
+import sqlite3
+
+from back_extract import file_sha256
+
+MRI_FOLDER = "./front/public/mri"
+TIMELINE_DB = os.environ.get("TIMELINE_DB", "./timeline.sqlite")
+SCAN_INFO_NAME = "scan.json"
+# Scans shown in a report trend
+TREND_SCANS = 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    patient TEXT NOT NULL,
+    scan TEXT NOT NULL,
+    date TEXT NOT NULL,
+    source TEXT,
+    lesion_count INTEGER NOT NULL,
+    volume REAL NOT NULL,
+    max_diameter REAL NOT NULL,
+    recorded_at TEXT NOT NULL,
+    UNIQUE (patient, scan)
+);
+CREATE INDEX IF NOT EXISTS scans_patient_date ON scans (patient, date);
+CREATE TABLE IF NOT EXISTS lesions (
+    scan_id INTEGER NOT NULL REFERENCES scans (id) ON DELETE CASCADE,
+    lesion INTEGER NOT NULL,
+    voxels INTEGER NOT NULL,
+    volume REAL NOT NULL,
+    max_diameter REAL NOT NULL,
+    bbox TEXT NOT NULL,
+    PRIMARY KEY (scan_id, lesion)
+);
+"""
+
+
+def connect(db_path=TIMELINE_DB):
+    """Open the timeline database, creating its tables on first use"""
+    directory = os.path.dirname(db_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(db_path)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA foreign_keys = ON")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def scan_key(id, mri_folder=MRI_FOLDER):
+    """Identity of scan `id`: the SHA-256 of its MRI file"""
+    return file_sha256(os.path.join(mri_folder, str(id), "mri_file.nii"))
+
+
+def scan_date(id, mri_folder=MRI_FOLDER):
+    """
+    Acquisition date of scan `id` as "YYYY-MM-DD"
+
+    From {"date": ...} in the scan's scan.json, else the modification date of its MRI file.
+    """
+    info_path = os.path.join(mri_folder, str(id), SCAN_INFO_NAME)
+    if os.path.exists(info_path):
+        with open(info_path, "r") as f:
+            date = json.load(f).get("date")
+        if date:
+            return datetime.date.fromisoformat(date).isoformat()
+    mtime = os.path.getmtime(os.path.join(mri_folder, str(id), "mri_file.nii"))
+    return datetime.date.fromtimestamp(mtime).isoformat()
+
+
+def record_scan(patient, scan, date, analysis, source=None, db_path=TIMELINE_DB):
+    """
+    Record or replace the metrics of one scan
+
+    Args:
+        patient (str): Patient name or identifier
+        scan (str): Identity of the scan, from scan_key
+        date (str): Scan date, "YYYY-MM-DD"
+        analysis (LesionAnalysis): Lesions of the scan (back_lesions.py)
+        source (str, optional): Mask the metrics were computed from
+
+    Returns:
+        int: Row id of the scan
+    """
+    recorded_at = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+    with connect(db_path) as connection:
+        # Updated in place, so a scan keeps its row id (and its order among scans of the same date)
+        connection.execute(
+            "INSERT INTO scans (patient, scan, date, source, lesion_count, volume, max_diameter, recorded_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (patient, scan) DO UPDATE SET date = excluded.date, source = excluded.source,"
+            " lesion_count = excluded.lesion_count, volume = excluded.volume,"
+            " max_diameter = excluded.max_diameter, recorded_at = excluded.recorded_at",
+            (patient, scan, date, source, analysis.count, analysis.volume, analysis.max_diameter, recorded_at),
+        )
+        scan_id = connection.execute(
+            "SELECT id FROM scans WHERE patient = ? AND scan = ?", (patient, scan),
+        ).fetchone()[0]
+        connection.execute("DELETE FROM lesions WHERE scan_id = ?", (scan_id,))
+        connection.executemany(
+            "INSERT INTO lesions (scan_id, lesion, voxels, volume, max_diameter, bbox) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (scan_id, lesion.id, lesion.voxels, lesion.volume, lesion.max_diameter,
+                 json.dumps([[s.start, s.stop] for s in lesion.bbox]))
+                for lesion in analysis.lesions
+            ),
+        )
+    connection.close()
+    return scan_id
+
+
+def trend(patient, limit=TREND_SCANS, until=None, db_path=TIMELINE_DB):
+    """
+    Totals of the last `limit` scans of a patient, oldest first
+
+    Args:
+        patient (str): Patient name or identifier
+        limit (int): Number of scans
+        until (str, optional): Last date to include, "YYYY-MM-DD"
+
+    Returns:
+        list: {"scan", "date", "lesion_count", "volume", "max_diameter"} of each scan
+    """
+    connection = connect(db_path)
+    try:
+        rows = connection.execute(
+            "SELECT scan, date, lesion_count, volume, max_diameter FROM scans"
+            " WHERE patient = ? AND date <= ? ORDER BY date DESC, id DESC LIMIT ?",
+            (patient, until or "9999-12-31", limit),
+        ).fetchall()
+    finally:
+        connection.close()
+    return [dict(row) for row in reversed(rows)]
+
+
+def scan_lesions(patient, scan, db_path=TIMELINE_DB):
+    """Recorded lesions of one scan (identified as in record_scan), largest first"""
+    connection = connect(db_path)
+    try:
+        rows = connection.execute(
+            "SELECT lesion, voxels, lesions.volume, lesions.max_diameter, bbox FROM lesions"
+            " JOIN scans ON scans.id = lesions.scan_id"
+            " WHERE scans.patient = ? AND scans.scan = ? ORDER BY lesions.volume DESC",
+            (patient, scan),
+        ).fetchall()
+    finally:
+        connection.close()
+    return [dict(row, bbox=json.loads(row["bbox"])) for row in rows]
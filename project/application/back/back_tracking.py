@@ -0,0 +1,138 @@
+'''
+Lesion tracking between two timepoints
+
+Lesions of two aligned masks (see back_lesions.py) are linked through the
+voxels they share. The overlap of every pair of lesions comes from a single
+bincount over the paired labels of the voxels that are lesion in both masks.
+Lesions linked by any overlap form a track, so a lesion that split or merged
+with others is followed as one site. Each track is then classified:
+- new: only in the later mask
+- resolved: only in the earlier mask
+- growing, shrinking or stable: from its relative volume change
+'''
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+STATUSES = ("new", "resolved", "growing", "shrinking", "stable")
+# Relative volume change under which a lesion is stable
+STABLE_FRACTION = 0.2
+# Largest overlap matrix counted densely with bincount; beyond it, only the pairs present are counted
+MAX_DENSE_PAIRS = 1 << 24
+
+
+class LesionTrack:
+    """One site of involvement followed from the earlier to the later mask"""
+
+    def __init__(self, before, after, volume_before, volume_after, status):
+        self.before = before
+        self.after = after
+        self.volume_before = volume_before
+        self.volume_after = volume_after
+        self.status = status
+
+    @property
+    def volume_change(self):
+        return self.volume_after - self.volume_before
+
+    def to_dict(self):
+        return {
+            "status": self.status,
+            "before": self.before,
+            "after": self.after,
+            "volume_before": self.volume_before,
+            "volume_after": self.volume_after,
+            "volume_change": self.volume_change,
+        }
+
+
+def overlap_pairs(labels_before, labels_after, n_before, n_after):
+    """
+    Voxels shared by every pair of overlapping lesions
+
+    Returns:
+        tuple: (before labels, after labels, overlapping voxels) arrays, one entry per overlapping pair
+    """
+    both = (labels_before != 0) & (labels_after != 0)
+    codes = labels_before[both].astype(np.int64) * (n_after + 1) + labels_after[both]
+    if (n_before + 1) * (n_after + 1) <= MAX_DENSE_PAIRS:
+        counts = np.bincount(codes, minlength=(n_before + 1) * (n_after + 1))
+        codes = np.flatnonzero(counts)
+        counts = counts[codes]
+    else:
+        codes, counts = np.unique(codes, return_counts=True)
+    return codes // (n_after + 1), codes % (n_after + 1), counts
+
+
+def _classify(volume_before, volume_after):
+    if volume_before == 0:
+        return "new"
+    if volume_after == 0:
+        return "resolved"
+    change = (volume_after - volume_before) / volume_before
+    if change > STABLE_FRACTION:
+        return "growing"
+    if change < -STABLE_FRACTION:
+        return "shrinking"
+    return "stable"
+
+
+def track_lesions(before, after):
+    """
+    Link the lesions of two timepoints and classify each site
+
+    Args:
+        before (LesionAnalysis): Analysis of the earlier mask
+        after (LesionAnalysis): Analysis of the later mask, aligned with the earlier one
+
+    Returns:
+        list: LesionTrack of each site, with the ids of its lesions at both timepoints
+    """
+    if before.labels.shape != after.labels.shape:
+        raise ValueError(f"Mask shapes differ: {before.labels.shape} and {after.labels.shape}")
+    n_before, n_after = before.count, after.count
+    ids_before = np.array([lesion.id for lesion in before.lesions], dtype=np.int64)
+    ids_after = np.array([lesion.id for lesion in after.lesions], dtype=np.int64)
+    i = j = np.zeros(0, dtype=np.int64)
+    if n_before and n_after:
+        # Lesions can only overlap on the slices holding lesions in both masks
+        start = max(before.slice_range()[0], after.slice_range()[0])
+        stop = min(before.slice_range()[1], after.slice_range()[1])
+        if start < stop:
+            i, j, _ = overlap_pairs(
+                before.labels[start:stop], after.labels[start:stop], int(ids_before.max()), int(ids_after.max()),
+            )
+
+    # Bipartite graph: nodes 0..n_before-1 are earlier lesions, then the later ones
+    node_before = np.zeros(int(ids_before.max(initial=0)) + 1, dtype=np.int64)
+    node_before[ids_before] = np.arange(n_before)
+    node_after = np.zeros(int(ids_after.max(initial=0)) + 1, dtype=np.int64)
+    node_after[ids_after] = np.arange(n_before, n_before + n_after)
+    n_nodes = n_before + n_after
+    graph = coo_matrix((np.ones(len(i)), (node_before[i], node_after[j])), shape=(n_nodes, n_nodes))
+    n_tracks, track_of = connected_components(graph, directed=False)
+
+    volumes = np.array([lesion.volume for lesion in before.lesions] + [lesion.volume for lesion in after.lesions])
+    volume_before = np.bincount(track_of[:n_before], weights=volumes[:n_before], minlength=n_tracks)
+    volume_after = np.bincount(track_of[n_before:], weights=volumes[n_before:], minlength=n_tracks)
+
+    members = [([], []) for _ in range(n_tracks)]
+    for node, track in enumerate(track_of):
+        if node < n_before:
+            members[track][0].append(int(ids_before[node]))
+        else:
+            members[track][1].append(int(ids_after[node - n_before]))
+    return [
+        LesionTrack(members[t][0], members[t][1], float(volume_before[t]), float(volume_after[t]),
+                    _classify(volume_before[t], volume_after[t]))
+        for t in range(n_tracks)
+    ]
+
+
+def tracking_summary(tracks):
+    """Number of sites of each status"""
+    summary = dict.fromkeys(STATUSES, 0)
+    for track in tracks:
+        summary[track.status] += 1
+    return summary
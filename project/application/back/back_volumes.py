@@ -0,0 +1,144 @@
+'''
+Shared cache of the MRI volumes and segmentation masks read by the backend
+
+Every module (slice rendering, report, MRI analysis) gets its volumes from here,
+so a file is read once per version on disk: entries are keyed by path and
+reloaded when the file's mtime or size changes.
+
+- MRI volumes are not converted: uncompressed NIfTI files are memory-mapped
+  through `dataobj` in their stored dtype instead of materialized as float64
+  by `get_fdata()`
+- Masks (NIfTI or RLE, see back_mask.py) are uint8
+- Each handle carries the voxel geometry of its volume (back_geometry.py),
+  read once with the file from its NIfTI header, for MRI volumes and masks alike
+
+Arrays are read-only, since they are shared between callers.
+'''
+
+import os
+import threading
+from collections import OrderedDict
+
+import nibabel as nib
+import numpy as np
+
+from back_geometry import geometry_from_affine, geometry_from_header
+from back_mask import find_mask, load_mask
+
+MRI_FOLDER = "./front/public/mri"
+# Loaded volumes kept at a time; memory-mapped volumes cost little until read
+MAX_CACHED_VOLUMES = 16
+
+
+class Volume:
+    """Handle on a cached volume: read-only voxel array and its geometry"""
+
+    def __init__(self, path, data, affine, geometry=None):
+        self.path = path
+        self.data = data
+        self.affine = affine
+        self.geometry = geometry if geometry is not None else geometry_from_affine(affine)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __repr__(self):
+        return f"Volume({self.path!r}, shape={self.shape}, dtype={self.data.dtype})"
+
+
+_cache = OrderedDict() # (kind, path) -> (file signature, Volume), least recently used first
+_cache_lock = threading.Lock()
+
+
+def file_signature(path):
+    """Identifies a version of a file on disk"""
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _read_only(array):
+    array = array.view()
+    array.flags.writeable = False
+    return array
+
+
+def _read_mri(path):
+    img = nib.load(path, mmap="r")
+    # A memmap for uncompressed files without intensity scaling, read as stored
+    return Volume(path, _read_only(np.asanyarray(img.dataobj)), img.affine, geometry_from_header(img.header, img.affine))
+
+
+def _read_mask(path):
+    mask, affine, header = load_mask(path)
+    # Same rule as the MRI: RLE files keep the full NIfTI header
+    return Volume(path, _read_only(mask), affine, geometry_from_header(header, affine))
+
+
+def _get(kind, path, reader):
+    key = (kind, os.path.abspath(path))
+    signature = file_signature(path)
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None and cached[0] == signature:
+            _cache.move_to_end(key)
+            return cached[1]
+    # Read outside the lock; a concurrent duplicate read is harmless
+    volume = reader(path)
+    with _cache_lock:
+        _cache[key] = (signature, volume)
+        _cache.move_to_end(key)
+        while len(_cache) > MAX_CACHED_VOLUMES:
+            _cache.popitem(last=False)
+    return volume
+
+
+def load_volume(path):
+    """
+    Get an MRI volume from the cache, reading it if needed
+
+    Args:
+        path (str): NIfTI file
+
+    Returns:
+        Volume: Read-only handle, memory-mapped when the file is uncompressed
+    """
+    return _get("mri", path, _read_mri)
+
+
+def load_mask_volume(path):
+    """
+    Get a segmentation mask from the cache, reading it if needed
+
+    Args:
+        path (str): Mask file (.rle, .nii, .nii.gz) or segmentation folder
+
+    Returns:
+        Volume: Read-only handle on the uint8 label volume
+    """
+    if os.path.isdir(path):
+        mask_path = find_mask(path)
+        if mask_path is None:
+            raise FileNotFoundError(f"No segmentation mask found in {path}")
+        path = mask_path
+    return _get("mask", path, _read_mask)
+
+
+def mri_path(id, mri_folder=MRI_FOLDER):
+    """MRI file of scan `id` (e.g. "0")"""
+    return os.path.join(mri_folder, str(id), "mri_file.nii")
+
+
+def load_mri(id, mri_folder=MRI_FOLDER):
+    """Cached MRI volume of scan `id`"""
+    return load_volume(mri_path(id, mri_folder))
+
+
+def load_seg(id, mri_folder=MRI_FOLDER):
+    """Cached segmentation mask of scan `id`"""
+    return load_mask_volume(os.path.join(mri_folder, f"{id}.seg"))
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,171 @@
+'''
+Code to serve volumes as compact uint8 binaries for client-side viewing
+
+Instead of one JPEG per slice, a viewer fetches a small JSON header and the
+voxels of a whole series, then scrolls and overlays locally. The binary is
+the uint8 volume in C order, reoriented so that axial slices lie along the
+first axis (inferior to superior, in radiological display orientation, see
+back_render.oriented_view) whatever the stored voxel order. Any run of axial
+slices is then one contiguous byte range: with HTTP Range requests a viewer
+can pull the study chunk by chunk (see `chunk_slices` in the header). The
+header's shape, spacing and affine describe the served, reoriented array.
+
+Kinds:
+- mri: the MRI, pre-windowed to 0-255 with one window for the whole volume
+- seg: the segmentation labels
+'''
+
+import hashlib
+import re
+
+import numpy as np
+
+from back_render import oriented_matrix, oriented_view
+from back_slices import ByteLRUCache
+from back_volumes import file_signature, load_mri, load_seg
+
+KINDS = ("mri", "seg")
+# Slices along the first axis of the served binary
+SLICE_ORIENTATION = "axial"
+# Intensity percentiles of the brain (non-zero voxels) mapped to 0 and 255
+WINDOW_PERCENTILES = (0.5, 99.5)
+# Slices per suggested range request
+CHUNK_SLICES = 16
+VOXEL_CACHE_BYTES = 256 * 1024 * 1024
+
+voxel_cache = ByteLRUCache(VOXEL_CACHE_BYTES)
+
+
+def _source(series, kind):
+    if not series.isdigit():
+        raise ValueError(f"Invalid series '{series}'")
+    if kind not in KINDS:
+        raise ValueError(f"Unknown kind '{kind}', expected one of {KINDS}")
+    return load_mri(series) if kind == "mri" else load_seg(series)
+
+
+def compute_window(data):
+    """Intensity window (low, high) from the percentiles of the non-zero voxels"""
+    # A strided sample is plenty for percentiles and avoids reading every voxel twice
+    sample = np.asarray(data[::2, ::2, ::2]).ravel()
+    sample = sample[sample != 0]
+    if sample.size == 0:
+        return 0.0, 1.0
+    low, high = np.percentile(sample, WINDOW_PERCENTILES)
+    return float(low), float(max(high, low + 1e-6))
+
+
+def to_uint8(data, window):
+    """Map intensities to 0-255 through a window, one slab at a time to bound memory"""
+    low, high = window
+    out = np.empty(data.shape, dtype=np.uint8)
+    scale = np.float32(255 / (high - low))
+    for start in range(0, data.shape[0], CHUNK_SLICES):
+        slab = np.array(data[start:start + CHUNK_SLICES], dtype=np.float32)
+        slab -= low
+        slab *= scale
+        np.clip(slab, 0, 255, out=slab)
+        out[start:start + CHUNK_SLICES] = slab
+    return out
+
+
+def _encode(series, kind):
+    """
+    Returns:
+        tuple: (header dict, uint8 voxel bytes)
+    """
+    volume = _source(series, kind)
+    data = oriented_view(volume.data, volume.affine, SLICE_ORIENTATION)
+    matrix = oriented_matrix(volume.affine, volume.shape, SLICE_ORIENTATION)
+    # Stored axis of each served axis
+    axes = np.abs(matrix[:3, :3]).argmax(axis=0)
+    if kind == "mri":
+        window = compute_window(data)
+        voxels = to_uint8(data, window)
+    else:
+        window = None
+        voxels = np.ascontiguousarray(data, dtype=np.uint8)
+
+    shape = [int(n) for n in voxels.shape]
+    header = {
+        "series": series,
+        "kind": kind,
+        "dtype": "uint8",
+        "order": "C",
+        "shape": shape,
+        "spacing": [round(float(s), 6) for s in volume.geometry.spacing_mm[axes]],
+        "affine": (np.asarray(volume.affine) @ matrix).round(6).tolist(),
+        "window": window,
+        "slice_axis": 0,
+        "orientation": SLICE_ORIENTATION,
+        "slice_bytes": int(np.prod(shape[1:])),
+        "chunk_slices": CHUNK_SLICES,
+        "size": int(voxels.nbytes),
+        "etag": _etag(volume.path, kind),
+    }
+    return header, voxels.tobytes()
+
+
+def _etag(path, kind):
+    parts = [path, kind, *map(str, file_signature(path)), str(WINDOW_PERCENTILES), SLICE_ORIENTATION]
+    return hashlib.sha1("\0".join(parts).encode()).hexdigest()
+
+
+_headers = {} # (series, kind) -> header of the latest encoding
+
+
+def get_voxels(series, kind):
+    """
+    Get the header and uint8 voxel bytes of a series, encoding them on first request
+
+    Returns:
+        tuple: (header dict, bytes)
+    """
+    etag = _etag(_source(series, kind).path, kind)
+    data = voxel_cache.get(etag)
+    header = _headers.get((series, kind))
+    if data is None or header is None or header["etag"] != etag:
+        header, data = _encode(series, kind)
+        _headers[(series, kind)] = header
+        voxel_cache.put(header["etag"], data)
+    return header, data
+
+
+def get_header(series, kind):
+    """JSON header of a series: shape, spacing, affine, window and chunking of the voxel binary"""
+    return get_voxels(series, kind)[0]
+
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(range_header, size):
+    """
+    Parse a single-range HTTP Range header
+
+    Returns:
+        tuple: (start, end) inclusive, or None to send the whole content (no header, or several ranges)
+
+    Raises:
+        ValueError: if the range cannot be satisfied (the response is then 416)
+    """
+    if not range_header:
+        return None
+    match = RANGE_PATTERN.match(range_header.strip())
+    if match is None:
+        # Multiple or unknown ranges: serving the whole content is allowed
+        return None
+    first, last = match.groups()
+    if first == "" and last == "":
+        return None
+    if first == "":
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = size - 1 if last == "" else min(int(last), size - 1)
+    if start >= size or start > end:
+        raise ValueError(f"Range {range_header} not satisfiable for {size} bytes")
+    return start, end
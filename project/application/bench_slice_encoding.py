@@ -0,0 +1,88 @@
+'''
+Throughput benchmark of the viewer slice extraction (back/back_extract.py)
+
+Extracts the same series as front/public/mri/slice.py (raw and overlay for two
+time points plus the difference, at every resolution level) into an empty
+folder with extract_series, the path slice.py runs, with 1 to N encoding threads.
+
+Examples:
+    # Synthetic 154x240x240 volumes
+    python bench_slice_encoding.py
+
+    # Real volumes, up to 16 threads
+    python bench_slice_encoding.py --mri front/public/mri/0/mri_file.nii front/public/mri/1/mri_file.nii --workers 1 2 4 8 16
+'''
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent / "back"))
+from back_extract import SeriesSpec, extract_series
+
+
+def synthetic_volume(shape, seed):
+    """Skull-stripped-like volume: smooth intensities inside an ellipsoid, zeros outside"""
+    rng = np.random.default_rng(seed)
+    zz, yy, xx = np.indices(shape, dtype=np.float32)
+    center = np.array(shape, dtype=np.float32) / 2
+    radius = sum(((axis - c) / c) ** 2 for axis, c in zip((zz, yy, xx), center))
+    volume = 300 + 100 * np.sin(xx / 9) * np.cos(yy / 13) + rng.normal(0, 10, shape)
+    return np.where(radius < 0.8, volume, 0).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JPEG slice encoding throughput for 1 to N workers")
+    parser.add_argument("--mri", nargs=2, help="Two .nii volumes (default: synthetic volumes)")
+    parser.add_argument("--workers", type=int, nargs="+", default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    mri_paths, seg_paths = [], []
+    for id, seed in (("0", 0), ("1", 1)):
+        if args.mri:
+            image = nib.load(args.mri[int(id)])
+            volume, affine = image.get_fdata(), image.affine
+        else:
+            volume, affine = synthetic_volume((154, 240, 240), seed), np.eye(4)
+        mri_paths.append(os.path.join(work_dir, f"mri_{id}.nii"))
+        seg_paths.append(os.path.join(work_dir, f"seg_{id}.nii"))
+        nib.save(nib.Nifti1Image(volume.astype(np.float32), affine), mri_paths[-1])
+        seg = (volume > np.percentile(volume, 99)).astype(np.uint8)
+        nib.save(nib.Nifti1Image(seg, affine), seg_paths[-1])
+
+    out_dir = os.path.join(work_dir, "out")
+    specs = [
+        SeriesSpec(os.path.join(out_dir, "0"), mri_paths[0]),
+        SeriesSpec(os.path.join(out_dir, "1"), mri_paths[1]),
+        SeriesSpec(os.path.join(out_dir, "0.seg"), mri_paths[0], [seg_paths[0]], mode="overlay"),
+        SeriesSpec(os.path.join(out_dir, "1.seg"), mri_paths[1], [seg_paths[1]], mode="overlay"),
+        SeriesSpec(os.path.join(out_dir, "difference"), mri_paths[1], seg_paths[::-1], mode="difference"),
+    ]
+
+    print(f"{'workers':>7} {'seconds':>8} {'slices/s':>9} {'speedup':>8}")
+    baseline = None
+    for workers in args.workers:
+        best = float("inf")
+        for _ in range(args.repeats):
+            # From scratch every time, or the series would be up to date and skipped
+            shutil.rmtree(out_dir, ignore_errors=True)
+            start = time.perf_counter()
+            count = sum(extract_series(specs, workers=workers).values())
+            best = min(best, time.perf_counter() - start)
+        baseline = baseline or best
+        print(f"{workers:>7} {best:>8.2f} {count / best:>9.0f} {baseline / best:>7.1f}x")
+
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
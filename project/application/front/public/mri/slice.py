@@ -1,13 +1,16 @@
-import cv2
-import numpy as np
 import os
-import nibabel as nib
+import sys
 from pathlib import Path
 
 # Get the directory where this script is located
 SCRIPT_DIR = Path(__file__).parent.resolve()
 BASE_DIR = SCRIPT_DIR  # mri directory
 
+# Incremental extraction is in back/back_extract.py, rendering in back/back_render.py
+sys.path.insert(0, str(SCRIPT_DIR.parents[2] / "back"))
+from back_extract import SeriesSpec, extract_series
+from back_registration import register_scans
+
 TO_SLICE = [
     str(BASE_DIR / "0"),
     str(BASE_DIR / "1")
@@ -18,81 +21,47 @@ SEG = {
 }
 DIFFERENCE = str(BASE_DIR / "difference")
 
-def extract_files():
-    for slice_path in TO_SLICE:
-        # Load the NIfTI file
-        img = nib.load(os.path.join(slice_path, "mri_file.nii"))
-        data = img.get_fdata()
-
-        for i in range(154):
-            slice = data[i]
-            min_val, max_val = np.min(slice), np.max(slice)
-            if max_val - min_val > 0:
-                slice = (slice - min_val) / (max_val - min_val) * 255
-            else:
-                slice = np.zeros_like(slice)
-            slice = slice.astype(np.uint8)
-            name = os.path.join(slice_path, f"slice_{i:03d}.jpg")
-            cv2.imwrite(name, slice)
-        
-        print(f"Saved slices for {slice_path} to disk.")
-
-    for seg_path, orig_path in SEG.items():
-        # Generate jpg of the slice with the segmentation as red on top
-        segmentation = nib.load(os.path.join(seg_path, "mri_file.nii")).get_fdata()
-        segmentation = (segmentation > 0).astype(np.float32)
-
-        orig_data = nib.load(os.path.join(orig_path, "mri_file.nii")).get_fdata()
-        for i in range(154):
-            orig_slice = orig_data[i]
-            seg_slice = segmentation[i]
-
-            # Normalize original slice
-            min_val, max_val = np.min(orig_slice), np.max(orig_slice)
-            orig_slice = (orig_slice - min_val) / (max_val - min_val) * 255
-            orig_slice = orig_slice.astype(np.uint8)
-
-            # Create a color image with red segmentation
-            color_image = cv2.cvtColor(orig_slice, cv2.COLOR_GRAY2BGR)
-            color_image[seg_slice > 0] = [0, 0, 255]
-            name = os.path.join(seg_path, f"slice_{i:03d}.jpg")
-            cv2.imwrite(name, color_image)
-
-    os.makedirs(DIFFERENCE, exist_ok=True)
-    seg_0_path = str(BASE_DIR / "0.seg" / "mri_file.nii")
-    seg_1_path = str(BASE_DIR / "1.seg" / "mri_file.nii")
-    seg_0 = nib.load(seg_0_path).get_fdata()
-    seg_1 = nib.load(seg_1_path).get_fdata()
-
-    # Calculate the difference
-    diff = np.abs(seg_1 - seg_0)
-
-    # Load the original MRI data for 1
-    orig_data = nib.load(str(BASE_DIR / "1" / "mri_file.nii")).get_fdata()
-
-    for i in range(154):
-        orig_slice = orig_data[i]
-        diff_slice = diff[i]
-
-        # Normalize original slice
-        min_val, max_val = np.min(orig_slice), np.max(orig_slice)
-        orig_slice = (orig_slice - min_val) / (max_val - min_val) * 255
-        orig_slice = orig_slice.astype(np.uint8)
-
-        # Create a color image with red difference
-        color_image = cv2.cvtColor(orig_slice, cv2.COLOR_GRAY2BGR)
-        color_image[diff_slice > 0] = [0, 0, 255]
-        
-        name = os.path.join(DIFFERENCE, f"slice_{i:03d}.jpg")
-        cv2.imwrite(name, color_image)
-
-    print("Saved difference slices to disk.")
+def series_specs(orientation=None):
+    """Series of the viewer, sliced along the stored first axis or an anatomical orientation"""
+    mri_file = lambda folder: os.path.join(folder, "mri_file.nii")
+    # Oriented series go to a subfolder of each series, e.g. 0.seg/coronal
+    out = lambda folder: folder if orientation is None else os.path.join(folder, orientation)
+
+    specs = [SeriesSpec(out(slice_path), mri_file(slice_path), orientation=orientation) for slice_path in TO_SLICE]
+    # Segmentation as red on top of the MRI
+    specs += [
+        SeriesSpec(out(seg_path), mri_file(orig_path), [seg_path], mode="overlay", orientation=orientation)
+        for seg_path, orig_path in SEG.items()
+    ]
+    # Red where the segmentation changed, on top of MRI 1; mask 0 is first aligned onto MRI 1
+    specs.append(SeriesSpec(
+        out(DIFFERENCE), mri_file(str(BASE_DIR / "1")),
+        [str(BASE_DIR / "1.seg"), str(BASE_DIR / "0.seg")], mode="difference", orientation=orientation,
+        transforms=[None, register_scans("1", "0", str(BASE_DIR))],
+    ))
+    return specs
+
+def extract_files(orientations=(None,)):
+    """
+    Args:
+        orientations (tuple): None for the series the viewer reads (stored first axis), and/or
+                              "axial", "coronal", "sagittal" for oriented series in subfolders
+    """
+    specs = [spec for orientation in orientations for spec in series_specs(orientation)]
+
+    # Only series and slices whose sources changed since the last run are rendered
+    written = extract_series(specs)
+    for folder, count in written.items():
+        name = os.path.relpath(folder, BASE_DIR)
+        print(f"{name}: {count} slices written" if count else f"{name}: up to date")
     return True
 
 
 if __name__ == "__main__":
+    # e.g. python slice.py axial coronal sagittal, to also write the oriented series
+    orientations = [None] + sys.argv[1:]
     try:
-        extract_files()
+        extract_files(orientations)
     except Exception as e:
         print(f"Error during extraction: {e}")
         raise e
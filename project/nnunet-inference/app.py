@@ -1,64 +1,108 @@
 # LIB for Fast API AND gcloud
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
+from typing import Optional
 import os
+import asyncio
 import tempfile
 import shutil
 from datetime import datetime
 import traceback
-from google.cloud import storage 
 
-# LIB for inference 
-import torch
-from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from mask_codec import RLE_SUFFIX, nifti_to_rle
+from gzip_stream import is_gzip_file
+from scheduler import PRIORITIES, DEFAULT_PRIORITY
+from pipeline import InferencePipeline
+from model_registry import ModelRegistry
 
 app = FastAPI(title="nnU-Net Inference API with GCS")
 
-# Predictor initialization
-predictor = None
+# Local stand-ins (used by load_test.py): a filesystem-backed GCS and a stub predictor
+LOCAL_GCS_ROOT = os.environ.get("NNUNET_LOCAL_GCS_ROOT")
+USE_STUB_PREDICTOR = os.environ.get("NNUNET_STUB_PREDICTOR", "0") == "1"
+
+# Hosted models: every trained model folder below MODELS_ROOT can be selected per request
+MODELS_ROOT = os.environ.get("NNUNET_MODELS_ROOT", "/app/dataset/nnUNet_trained_models")
+DEFAULT_MODEL = os.environ.get("NNUNET_DEFAULT_MODEL", "Dataset001_LUMIERE")
+MODEL_MEMORY_BUDGET_MB = float(os.environ.get("NNUNET_MODEL_MEMORY_BUDGET_MB", "4096"))
+
+def load_predictor(model_path, folds):
+    """Loads the predictor of one trained model folder."""
+    if USE_STUB_PREDICTOR:
+        from stub_predictor import StubPredictor
+        print("Using stub predictor")
+        return StubPredictor(latency=float(os.environ.get("NNUNET_STUB_LATENCY", "0.5")))
+
+    # LIB for inference 
+    from nnunet_stages import NnUNetStages
+
+    print("Initializing nnU-Net predictor...")
+    predictor = NnUNetStages(model_path, folds=folds)
+    print("Predictor initialized successfully")
+    print(f"Using device: {predictor.device}")
+    return predictor
+
+def release_predictor(predictor):
+    """Returns the GPU memory cached for an evicted predictor."""
+    if not USE_STUB_PREDICTOR:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+# Predictors are loaded lazily and evicted LRU under the memory budget (see model_registry.py)
+models = ModelRegistry(
+    MODELS_ROOT,
+    load_predictor,
+    memory_budget_bytes=int(MODEL_MEMORY_BUDGET_MB * 2**20),
+    default_model=DEFAULT_MODEL,
+    folds=(0,),
+    on_evict=release_predictor,
+)
 
 def initialize_predictor():
-    """Initializes the nnU-Net predictor."""
-    global predictor
-    if predictor is None:
-        print("Initializing nnU-Net predictor...")
-        model_path = "/app/dataset/nnUNet_trained_models/Dataset001_LUMIERE/"
-        if not os.path.exists(model_path):
-            raise RuntimeError(f"Model path does not exist: {model_path}")
-
-        predictor = nnUNetPredictor(
-            tile_step_size=0.5,
-            use_gaussian=True,
-            use_mirroring=True,
-            device=torch.device('cuda' if torch.cuda.is_available() else 'cpu'),
-            verbose=False, 
-        )
-        predictor.initialize_from_trained_model_folder(
-            model_training_output_dir=model_path,
-            use_folds=(0,),
-        )
-        print("Predictor initialized successfully")
-        print(f"Using device: {predictor.device}")
+    """Loads the default model so the first request does not pay for it."""
+    models.resolve(DEFAULT_MODEL)
+    models.get(DEFAULT_MODEL)
 
 @app.on_event("startup")
 async def startup_event():
     initialize_predictor()
+    pipeline.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    pipeline.stop()
 
 # Health check of the endpoint
 @app.get("/health", status_code=200)
 async def health():
-    return {"status": "healthy"}
+    return {"status": "healthy", "pipeline": pipeline.stats(), "models": models.stats()}
 
 # Pydantic model for the core prediction request parameters
 class PredictRequestCore(BaseModel):
     input_gcs_uri: str # Ex: "gs://my-input-bucket/LUMIERE_001_0000.nii.gz"
     output_gcs_prefix: str # Ex: "gs://my-output-bucket/results/"
+    output_format: str = "nifti" # "nifti" (.nii.gz) or "rle" (compact run-length encoded mask, see mask_codec.py)
+    priority: str = DEFAULT_PRIORITY # "urgent" (clinical reads), "normal" or "batch" (cohort backfills)
+    model: Optional[str] = None # Trained model folder below NNUNET_MODELS_ROOT, Ex: "Dataset001_LUMIERE" (default)
+    return_uncertainty: bool = False # Also return a disagreement map of the mirrored TTA passes and per-lesion scores
 
 # NEW: Pydantic model for the Vertex AI prediction request format
 # Vertex AI wraps your input JSON inside an 'instances' array.
 class VertexAIPredictRequest(BaseModel):
     instances: list[PredictRequestCore] # Expects a list where each item is a PredictRequestCore
 
+OUTPUT_FORMATS = ("nifti", "rle")
+
+def get_storage_client():
+    """Returns the GCS client, or the local filesystem stand-in if NNUNET_LOCAL_GCS_ROOT is set."""
+    if LOCAL_GCS_ROOT:
+        from local_gcs import LocalStorageClient
+        return LocalStorageClient(LOCAL_GCS_ROOT)
+    from google.cloud import storage
+    # Ensure 'gemma-hcls25par-722' is your correct Google Cloud Project ID
+    return storage.Client(project='gemma-hcls25par-722')
+
 def parse_gcs_uri(gcs_uri: str) -> (str, str):
     """Separates a GCS URI into bucket name and blob name."""
     if not gcs_uri.startswith("gs://"):
@@ -68,106 +112,208 @@ def parse_gcs_uri(gcs_uri: str) -> (str, str):
     blob_name = parts[1] if len(parts) > 1 else ""
     return bucket_name, blob_name
 
-# Adjusted /predict endpoint to accept the VertexAIPredictRequest
-@app.post("/predict")
-async def predict(request_payload: VertexAIPredictRequest): # Renamed `request` to `request_payload` for clarity
+class PredictionJob:
+    """State of one volume as it moves through the pipeline stages."""
+
+    def __init__(self, request: PredictRequestCore, model_name: str):
+        self.request = request
+        self.model_name = model_name
+        self.predictor = None
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.temp_dir, "input")
+        self.output_dir = os.path.join(self.temp_dir, "output")
+        os.makedirs(self.input_dir)
+        os.makedirs(self.output_dir)
+        self.input_filename = None
+        self.data = None
+        self.properties = None
+        self.logits = None
+        self.uncertainty = None
+
+def case_identifier(filename: str) -> str:
+    """nnU-Net case name of an input file: no extension, no channel suffix."""
+    for ending in (".nii.gz", ".nii"):
+        if filename.endswith(ending):
+            filename = filename[:-len(ending)]
+            break
+    return filename[:-len("_0000")] if filename.endswith("_0000") else filename
+
+def match_compression_ending(path: str) -> str:
     """
-    Launches inference from a file in GCS and saves the result to GCS.
-    This endpoint is designed to accept requests formatted for Vertex AI custom prediction.
+    Inputs may be uploaded as .nii or .nii.gz. The readers pick gzip from the extension,
+    so rename the file if its extension does not match its content. Returns the path.
     """
+    if not path.endswith((".nii", ".nii.gz")):
+        raise ValueError(f"Unsupported input file '{os.path.basename(path)}', expected .nii or .nii.gz")
+    compressed = is_gzip_file(path)
+    if compressed == path.endswith(".gz"):
+        return path
+    fixed_path = path + ".gz" if compressed else path[:-len(".gz")]
+    os.replace(path, fixed_path)
+    return fixed_path
+
+def download_and_preprocess(job: PredictionJob) -> None:
+    """Stage 1: downloads the volume from GCS and runs nnU-Net preprocessing."""
+    request = job.request
+    storage_client = get_storage_client()
+
+    # --- 1. Download file from GCS ---
+    input_bucket_name, input_blob_name = parse_gcs_uri(request.input_gcs_uri)
+    job.input_filename = os.path.basename(input_blob_name)
+    local_input_path = os.path.join(job.input_dir, job.input_filename)
     
-    # Vertex AI sends a list of instances. For this API, we expect one instance.
-    if not request_payload.instances:
-        raise HTTPException(status_code=400, detail="No instances provided in the request payload.")
+    print(f"Downloading {request.input_gcs_uri} to {local_input_path}...")
+    bucket = storage_client.bucket(input_bucket_name)
+    blob = bucket.blob(input_blob_name)
+    blob.download_to_filename(local_input_path)
+    print("Download complete.")
+    local_input_path = match_compression_ending(local_input_path)
+
+    # --- 2a. Preprocess (crop, resample, normalize) ---
+    # The job keeps its predictor to the end, even if the model gets evicted meanwhile
+    job.predictor = models.get(job.model_name)
+    print(f"Preprocessing file: {local_input_path} for model {job.model_name}")
+    job.data, job.properties = job.predictor.preprocess(local_input_path)
+
+def run_inference(job: PredictionJob) -> None:
+    """Stage 2: network inference, the only stage that uses the GPU."""
+    # --- 2b. Execute nnU-Net inference ---
+    print(f"Running inference for {job.request.input_gcs_uri}")
+    job.logits, job.uncertainty = job.predictor.predict(job.data, with_uncertainty=job.request.return_uncertainty)
+    job.data = None
+    print("Inference complete.")
+
+def export_and_upload(job: PredictionJob) -> dict:
+    """Stage 3: exports the mask in the input geometry and uploads the results to GCS."""
+    request = job.request
+
+    # --- 2c. Export the segmentation ---
+    exported = job.predictor.export(
+        job.logits, job.properties, os.path.join(job.output_dir, case_identifier(job.input_filename)),
+        uncertainty=job.uncertainty,
+    )
+    job.logits = job.uncertainty = None
+
+    # --- 3. Upload results to GCS ---
+    output_files = os.listdir(job.output_dir)
+    if not output_files:
+        raise RuntimeError("Inference did not produce any output file.")
     
-    # Extract the actual prediction request from the first instance
-    # This is the original structure your FastAPI app was designed to handle
-    request: PredictRequestCore = request_payload.instances[0] 
+    uploaded_files_uris = [] # To store the URIs of all uploaded files
 
-    temp_dir = tempfile.mkdtemp()
-    try:
-        # Ensure 'gemma-hcls25par-722' is your correct Google Cloud Project ID
-        storage_client = storage.Client(project='gemma-hcls25par-722')
+    storage_client = get_storage_client()
+    output_bucket_name, output_prefix = parse_gcs_uri(request.output_gcs_prefix)
+    output_bucket = storage_client.bucket(output_bucket_name)
 
-        # --- 1. Download file from GCS ---
-        input_bucket_name, input_blob_name = parse_gcs_uri(request.input_gcs_uri)
-        input_filename = os.path.basename(input_blob_name)
+    for filename in output_files:
+        local_output_path = os.path.join(job.output_dir, filename)
 
-        input_dir = os.path.join(temp_dir, "input")
-        output_dir = os.path.join(temp_dir, "output")
-        os.makedirs(input_dir)
-        os.makedirs(output_dir)
+        # Re-encode masks (and uncertainty maps) as compact RLE if requested
+        if request.output_format == "rle" and filename.endswith(".nii.gz"):
+            rle_filename = filename[:-len(".nii.gz")] + RLE_SUFFIX
+            rle_path = os.path.join(job.output_dir, rle_filename)
+            rle_size = nifti_to_rle(local_output_path, rle_path)
+            print(f"Encoded {filename} ({os.path.getsize(local_output_path)} bytes) as {rle_filename} ({rle_size} bytes)")
+            filename, local_output_path = rle_filename, rle_path
 
-        local_input_path = os.path.join(input_dir, input_filename)
-        
-        print(f"Downloading {request.input_gcs_uri} to {local_input_path}...")
-        bucket = storage_client.bucket(input_bucket_name)
-        blob = bucket.blob(input_blob_name)
-        blob.download_to_filename(local_input_path)
-        print("Download complete.")
-
-        # --- 2. Execute nnU-Net inference ---
-        print(f"Processing file: {local_input_path}")
-        predictor.predict_from_files(
-            input_dir, # nnU-Net expects an input folder here if multiple files are to be processed
-            output_dir,
-            save_probabilities=False,
-            overwrite=True,
-            num_processes_preprocessing=1,
-            num_processes_segmentation_export=1
-        )
-        print("Inference complete.")
-
-        # --- 3. Upload results to GCS ---
-        output_files = os.listdir(output_dir)
-        if not output_files:
-            raise HTTPException(status_code=500, detail="Inference did not produce any output file.")
+        # Clean up the input filename for use in the output folder name
+        input_file_base_name = os.path.splitext(job.input_filename)[0]
+        if job.model_name != models.default_model:
+            input_file_base_name += "_" + job.model_name.replace("/", "_")
         
-        uploaded_files_uris = [] # To store the URIs of all uploaded files
+        # Create a specific output folder for this prediction run
+        output_folder_for_this_run = os.path.join(output_prefix.strip("/"), f"{input_file_base_name}_nnunet_output")
+        output_blob_name = os.path.join(output_folder_for_this_run, filename)
 
-        output_bucket_name, output_prefix = parse_gcs_uri(request.output_gcs_prefix)
-        output_bucket = storage_client.bucket(output_bucket_name)
 
-        for filename in output_files:
-            local_output_path = os.path.join(output_dir, filename)
+        print(f"Uploading {local_output_path} to gs://{output_bucket_name}/{output_blob_name}...")
+        output_blob = output_bucket.blob(output_blob_name)
+        output_blob.upload_from_filename(local_output_path)
+        print(f"Upload of {filename} complete.")
+        uploaded_files_uris.append(f"gs://{output_bucket_name}/{output_blob_name}")
 
-            # Clean up the input filename for use in the output folder name
-            input_file_base_name = os.path.splitext(input_filename)[0]
-            
-            # Create a specific output folder for this prediction run
-            output_folder_for_this_run = os.path.join(output_prefix.strip("/"), f"{input_file_base_name}_nnunet_output")
-            output_blob_name = os.path.join(output_folder_for_this_run, filename)
+    result = {
+        "status": "success",
+        "input_gcs_uri": request.input_gcs_uri,
+        "output_gcs_uris": uploaded_files_uris, # The response will contain a list of URIs
+        "priority": request.priority,
+        "model": job.model_name,
+        "timestamp": datetime.utcnow().isoformat()
+    }
+    if request.return_uncertainty:
+        # None when the model runs without mirroring: there are no passes to compare
+        result["lesion_uncertainty"] = exported.get("lesion_uncertainty")
+    return result
 
+def cleanup_job(job: PredictionJob) -> None:
+    job.predictor = None
+    # Clean up temporary directory
+    if os.path.exists(job.temp_dir):
+        shutil.rmtree(job.temp_dir)
 
-            print(f"Uploading {local_output_path} to gs://{output_bucket_name}/{output_blob_name}...")
-            output_blob = output_bucket.blob(output_blob_name)
-            output_blob.upload_from_filename(local_output_path)
-            print(f"Upload of {filename} complete.")
-            uploaded_files_uris.append(f"gs://{output_bucket_name}/{output_blob_name}")
+# Inference jobs flow through preprocess -> inference -> export stages, urgent first (see pipeline.py)
+pipeline = InferencePipeline(
+    download_and_preprocess,
+    run_inference,
+    export_and_upload,
+    cleanup=cleanup_job,
+    preprocess_workers=int(os.environ.get("NNUNET_PREPROCESS_WORKERS", "2")),
+    export_workers=int(os.environ.get("NNUNET_EXPORT_WORKERS", "2")),
+    depth=int(os.environ.get("NNUNET_PIPELINE_DEPTH", "2")),
+    aging_seconds=float(os.environ.get("NNUNET_AGING_SECONDS", "120")),
+)
 
-        final_output_uris = uploaded_files_uris # The response will contain a list of URIs
-        
-        return {
-            "predictions": [  # <- Ceci est requis par Vertex AI
-                {
-                    "status": "success",
-                    "input_gcs_uri": request.input_gcs_uri,
-                    "output_gcs_uris": final_output_uris,
-                    "timestamp": datetime.utcnow().isoformat()
-                }
-            ]
-        }
+# Adjusted /predict endpoint to accept the VertexAIPredictRequest
+@app.post("/predict")
+async def predict(request_payload: VertexAIPredictRequest): # Renamed `request` to `request_payload` for clarity
+    """
+    Launches inference from files in GCS and saves the results to GCS.
+    This endpoint is designed to accept requests formatted for Vertex AI custom prediction.
+
+    Every instance is scheduled as its own job in its priority class, so a large
+    batch request yields to urgent requests between volumes. Volumes are pipelined:
+    one is preprocessed while another is on the GPU and a third is exported.
+    """
+    
+    # Vertex AI sends a list of instances, one volume per instance
+    if not request_payload.instances:
+        raise HTTPException(status_code=400, detail="No instances provided in the request payload.")
     
-    except Exception as e:
-        error_msg = f"Prediction failed: {str(e)}"
-        print(error_msg)
-        print(traceback.format_exc())
-        raise HTTPException(status_code=500, detail=error_msg)
-
-    finally:
-        # Clean up temporary directory
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
+    for request in request_payload.instances:
+        if request.output_format not in OUTPUT_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Unknown output_format '{request.output_format}', expected one of {OUTPUT_FORMATS}")
+        if request.priority not in PRIORITIES:
+            raise HTTPException(status_code=400, detail=f"Unknown priority '{request.priority}', expected one of {list(PRIORITIES)}")
+    try:
+        model_names = [models.resolve(request.model)[0] for request in request_payload.instances]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    futures = [
+        asyncio.wrap_future(pipeline.submit(PredictionJob(request, model_name), request.priority))
+        for request, model_name in zip(request_payload.instances, model_names)
+    ]
+    results = await asyncio.gather(*futures, return_exceptions=True)
+
+    predictions = [] # <- Ceci est requis par Vertex AI
+    for request, result in zip(request_payload.instances, results):
+        if isinstance(result, Exception):
+            error_msg = f"Prediction failed: {str(result)}"
+            print(error_msg)
+            print("".join(traceback.format_exception(result)))
+            result = {
+                "status": "error",
+                "input_gcs_uri": request.input_gcs_uri,
+                "error": error_msg,
+                "timestamp": datetime.utcnow().isoformat()
+            }
+        predictions.append(result)
+
+    # Keep failing the whole call when nothing succeeded (e.g. the single-volume case)
+    if all(prediction["status"] == "error" for prediction in predictions):
+        raise HTTPException(status_code=500, detail=predictions[0]["error"])
+
+    return {"predictions": predictions}
 
 @app.get("/")
 async def root():
@@ -0,0 +1,107 @@
+"""
+Benchmark of the on-the-fly gzip compression used by test_remote_endpoint.py.
+
+For each compression level and thread count it measures the compression time
+(wall and CPU) and the compressed size. From the size it estimates the upload
+time at the given link speeds. Compression is streamed into the upload, so the
+upload takes about max(compression, transfer). The raw upload is the "none" row.
+
+Examples:
+    # Synthetic skull-stripped volume (mostly zeros), default levels and links
+    python bench_upload_compression.py
+
+    # Real volume, levels 1 and 6, on 1 and 8 threads, over 20 and 100 Mbit/s
+    python bench_upload_compression.py --input ../application/front/public/mri/0/mri_file.nii --levels 1 6 --threads 1 8 --bandwidth_mbps 20 100
+"""
+
+import argparse
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from gzip_stream import compress_file
+from load_test import make_synthetic_volume
+
+
+class CountingSink:
+    """Write-only file object that only counts bytes, standing in for the upload."""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+
+def measure(input_file, level, threads, repeats):
+    """Best of `repeats` runs. Returns (wall seconds, CPU seconds, compressed bytes)."""
+    best = None
+    for _ in range(repeats):
+        sink = CountingSink()
+        wall, cpu = time.perf_counter(), time.process_time()
+        compress_file(input_file, sink, level=level, threads=threads)
+        run = (time.perf_counter() - wall, time.process_time() - cpu, sink.size)
+        if best is None or run[0] < best[0]:
+            best = run
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU vs bandwidth trade-off of compressed uploads")
+    parser.add_argument("--input", help="Uncompressed .nii volume (default: synthetic 154x240x240 float32 volume)")
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 3, 6, 9])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, os.cpu_count() or 1])
+    parser.add_argument("--bandwidth_mbps", type=float, nargs="+", default=[10, 100, 1000],
+                        help="Upload link speeds in Mbit/s")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    input_file = args.input
+    if input_file is None:
+        input_file = os.path.join(temp_dir, "synthetic.nii")
+        make_synthetic_volume(input_file)
+    elif input_file.endswith(".gz"):
+        # Benchmark on the uncompressed volume, as the application stores it
+        with gzip.open(input_file, "rb") as src, open(os.path.join(temp_dir, "input.nii"), "wb") as dst:
+            dst.write(src.read())
+        input_file = os.path.join(temp_dir, "input.nii")
+
+    original_size = os.path.getsize(input_file)
+    print(f"Input: {input_file} ({original_size / 2**20:.1f} MB)")
+
+    results = [{"level": None, "threads": None, "wall_s": 0.0, "cpu_s": 0.0, "size": original_size}]
+    for level in sorted(set(args.levels)):
+        for threads in sorted(set(args.threads)):
+            wall, cpu, size = measure(input_file, level, threads, args.repeats)
+            results.append({"level": level, "threads": threads, "wall_s": wall, "cpu_s": cpu, "size": size})
+
+    header = f"{'level':>5} {'threads':>7} {'wall s':>7} {'cpu s':>7} {'MB':>7} {'ratio':>6}"
+    header += "".join(f" {f'@{mbps:g}Mb/s':>10}" for mbps in args.bandwidth_mbps)
+    print(header)
+    for result in results:
+        result["ratio"] = original_size / max(result["size"], 1)
+        # Streaming overlaps compression with the transfer
+        result["upload_s"] = {
+            str(mbps): max(result["wall_s"], result["size"] * 8 / (mbps * 1e6)) for mbps in args.bandwidth_mbps
+        }
+        level = "none" if result["level"] is None else result["level"]
+        threads = "-" if result["threads"] is None else result["threads"]
+        line = f"{level:>5} {threads:>7} {result['wall_s']:>7.2f} {result['cpu_s']:>7.2f} "
+        line += f"{result['size'] / 2**20:>7.2f} {result['ratio']:>6.1f}"
+        line += "".join(f" {result['upload_s'][str(mbps)]:>9.2f}s" for mbps in args.bandwidth_mbps)
+        print(line)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"input": args.input, "original_size": original_size, "results": results}, f, indent=2)
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Multi-threaded gzip compression of a stream, in the manner of pigz.
+
+The input is cut into blocks that are deflated in parallel (zlib releases the
+GIL while compressing). Each block is primed with the last 32 KiB of the
+previous one, so the ratio is close to single-threaded gzip. Every block but
+the last ends with a sync flush, so the raw deflate streams concatenate into one
+valid stream. A single gzip header and the CRC-32/size trailer wrap it. The
+result is a standard .gz file readable by gzip, nibabel and SimpleITK.
+
+Only `threads * 2` blocks are held in memory at a time, so a volume can be
+compressed straight into an upload without writing a temporary compressed file.
+"""
+
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_LEVEL = 6
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+# Deflate window: each block may refer back this far into the previous one
+DICTIONARY_SIZE = 32 * 1024
+
+# Magic, deflate method, no flags, no mtime (reproducible output), unknown OS
+GZIP_HEADER = b"\x1f\x8b\x08\x00" + b"\x00\x00\x00\x00" + b"\x00\xff"
+
+
+def is_gzip_file(path):
+    """True if the file starts with the gzip magic bytes, whatever its extension."""
+    with open(path, "rb") as f:
+        return f.read(2) == b"\x1f\x8b"
+
+
+def _deflate_block(block, dictionary, level, last):
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def iter_gzip(src, level=DEFAULT_LEVEL, threads=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Compresses a binary file object into gzip, yielding the compressed bytes in order.
+
+    Args:
+        src (file): Binary file object to read from
+        level (int): zlib compression level, 0 (store) to 9
+        threads (int, optional): Compression threads, defaults to the number of CPUs
+        block_size (int): Uncompressed bytes per block
+
+    Yields:
+        bytes: Consecutive pieces of the gzip stream
+    """
+    threads = threads or os.cpu_count() or 1
+    yield GZIP_HEADER
+
+    crc, size = 0, 0
+    pending = [] # Futures of submitted blocks, in stream order
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        block, dictionary = src.read(block_size), b""
+        while True:
+            next_block = src.read(block_size)
+            last = not next_block
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            pending.append(executor.submit(_deflate_block, block, dictionary, level, last))
+            # Keep the workers busy while bounding the memory held in flight
+            while len(pending) > threads * 2 or (last and pending):
+                yield pending.pop(0).result()
+            if last:
+                break
+            dictionary = block[-DICTIONARY_SIZE:]
+            block = next_block
+
+    yield struct.pack("<II", crc, size & 0xFFFFFFFF)
+
+
+def compress_file(src_path, dst, level=DEFAULT_LEVEL, threads=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Writes the gzip compression of `src_path` to the writable binary file object `dst`.
+
+    Returns:
+        int: Number of compressed bytes written
+    """
+    written = 0
+    with open(src_path, "rb") as src:
+        for piece in iter_gzip(src, level=level, threads=threads, block_size=block_size):
+            dst.write(piece)
+            written += len(piece)
+    return written
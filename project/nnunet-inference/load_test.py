@@ -0,0 +1,221 @@
+"""
+Load test for the nnU-Net inference API (app.py).
+
+By default the script starts app.py locally with a filesystem-backed fake GCS
+(local_gcs.py) and, with --stub, a stub predictor (stub_predictor.py), seeds the
+input volume into the fake bucket, then drives /predict at the requested
+concurrency and rate. It reports p50/p95/p99 latency, throughput and error rate.
+
+Examples:
+    # Stub predictor, 4 concurrent clients, 50 requests as fast as possible
+    python load_test.py --stub --concurrency 4 --requests 50
+
+    # Real model on a GPU host, open loop at 0.5 request/s for 2 minutes
+    python load_test.py --input data/LUMIERE_001_0000.nii.gz --rate 0.5 --duration 120
+
+    # Existing server (it must use the same NNUNET_LOCAL_GCS_ROOT as --gcs_root)
+    python load_test.py --url http://localhost:8080 --gcs_root /tmp/fake-gcs --requests 20
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
+import requests
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+INPUT_BUCKET = "nnunet-input-bucket"
+OUTPUT_BUCKET = "nnunet-output-bucket"
+INPUT_BLOB_NAME = "load-test/case_0000.nii.gz"
+OUTPUT_PREFIX = "load-test-results/"
+
+
+# --- Setup of the local stand-ins ---
+def make_synthetic_volume(path, shape=(154, 240, 240), seed=0):
+    """Writes a random skull-stripped-like FLAIR volume to `path`."""
+    rng = np.random.default_rng(seed)
+    zz, yy, xx = np.indices(shape, dtype=np.float32)
+    center = np.array(shape, dtype=np.float32) / 2
+    radius = ((zz - center[0]) / center[0]) ** 2 + ((yy - center[1]) / center[1]) ** 2 + ((xx - center[2]) / center[2]) ** 2
+    volume = np.where(radius < 0.8, rng.normal(300, 40, shape), 0).astype(np.float32)
+    nib.save(nib.Nifti1Image(volume, np.eye(4)), path)
+
+
+def seed_input(gcs_root, input_file):
+    """Copies the input volume into the fake input bucket."""
+    blob_path = os.path.join(gcs_root, INPUT_BUCKET, INPUT_BLOB_NAME)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    if input_file:
+        shutil.copyfile(input_file, blob_path)
+    else:
+        make_synthetic_volume(blob_path)
+    return f"gs://{INPUT_BUCKET}/{INPUT_BLOB_NAME}"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(gcs_root, stub, stub_latency, port, startup_timeout):
+    """Starts app.py with uvicorn and waits for /health."""
+    env = dict(os.environ)
+    env["NNUNET_LOCAL_GCS_ROOT"] = gcs_root
+    if stub:
+        env["NNUNET_STUB_PREDICTOR"] = "1"
+        env["NNUNET_STUB_LATENCY"] = str(stub_latency)
+        # The stub needs no weights, only the model folders shipped with the repo
+        env.setdefault("NNUNET_MODELS_ROOT", os.path.join(SCRIPT_DIR, "nnUNet_trained_models"))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=SCRIPT_DIR,
+        env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + startup_timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited during startup with code {process.returncode}")
+        try:
+            if requests.get(f"{url}/health", timeout=1).status_code == 200:
+                return process, url
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"Server did not become healthy within {startup_timeout}s")
+
+
+# --- Load generation ---
+def run_load(url, payload, concurrency, rate, num_requests, duration, timeout):
+    """
+    Sends requests and returns a list of (latency in seconds, ok, error) tuples plus the wall time.
+
+    With a rate, requests are scheduled open loop and latency is measured from the
+    scheduled send time, so queueing in front of the server is not hidden.
+    Without a rate, `concurrency` clients send back to back (closed loop).
+    """
+    results = []
+    lock = threading.Lock()
+
+    def send(scheduled_at):
+        try:
+            response = requests.post(f"{url}/predict", json=payload, timeout=timeout)
+            ok, error = response.status_code == 200, None if response.status_code == 200 else f"HTTP {response.status_code}"
+        except requests.exceptions.RequestException as e:
+            ok, error = False, type(e).__name__
+        with lock:
+            results.append((time.perf_counter() - scheduled_at, ok, error))
+
+    start = time.perf_counter()
+    end = start + duration if duration else None
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        i = 0
+        while (num_requests is None or i < num_requests) and (end is None or time.perf_counter() < end):
+            if rate:
+                scheduled_at = start + i / rate
+                delay = scheduled_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(send, scheduled_at)
+            else:
+                # Closed loop: wait for a free client before submitting
+                while i - len(results) >= concurrency:
+                    time.sleep(0.001)
+                pool.submit(send, time.perf_counter())
+            i += 1
+    return results, time.perf_counter() - start
+
+
+def summarize(results, wall_time):
+    latencies = np.array([latency for latency, ok, _ in results if ok])
+    errors = [error for _, ok, error in results if not ok]
+    summary = {
+        "requests": len(results),
+        "errors": len(errors),
+        "error_rate": len(errors) / len(results) if results else 0.0,
+        "throughput_rps": len(latencies) / wall_time if wall_time > 0 else 0.0,
+        "wall_time_s": wall_time,
+        "error_kinds": {kind: errors.count(kind) for kind in set(errors)},
+    }
+    if latencies.size:
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        summary.update(latency_p50_s=p50, latency_p95_s=p95, latency_p99_s=p99,
+                       latency_mean_s=latencies.mean(), latency_max_s=latencies.max())
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the nnU-Net inference API")
+    parser.add_argument("--url", help="URL of a running server (default: start app.py locally)")
+    parser.add_argument("--gcs_root", help="Fake GCS directory (default: a temporary directory)")
+    parser.add_argument("--input", help="Input NIfTI volume (default: a synthetic volume)")
+    parser.add_argument("--stub", action="store_true", help="Use the stub predictor instead of nnU-Net")
+    parser.add_argument("--stub_latency", type=float, default=0.5, help="Stub inference time in seconds (default: 0.5)")
+    parser.add_argument("--concurrency", type=int, default=1, help="Maximum requests in flight (default: 1)")
+    parser.add_argument("--rate", type=float, default=0.0, help="Open loop request rate per second (default: closed loop)")
+    parser.add_argument("--requests", type=int, default=None, help="Number of requests (default: 20 unless --duration)")
+    parser.add_argument("--duration", type=float, default=None, help="Test duration in seconds")
+    parser.add_argument("--output_format", choices=["nifti", "rle"], default="nifti")
+    parser.add_argument("--model", help="Model to request (default: the server's default model)")
+    parser.add_argument("--priority", choices=["urgent", "normal", "batch"], default="normal", help="Priority class of the requests")
+    parser.add_argument("--timeout", type=float, default=600.0, help="Per request timeout in seconds")
+    parser.add_argument("--startup_timeout", type=float, default=300.0, help="Server startup timeout in seconds")
+    parser.add_argument("--json", help="Also write the summary to this JSON file")
+    args = parser.parse_args()
+
+    if args.requests is None and args.duration is None:
+        args.requests = 20
+
+    gcs_root = args.gcs_root or tempfile.mkdtemp(prefix="fake-gcs-")
+    input_uri = seed_input(gcs_root, args.input)
+    payload = {"instances": [{
+        "input_gcs_uri": input_uri,
+        "output_gcs_prefix": f"gs://{OUTPUT_BUCKET}/{OUTPUT_PREFIX}",
+        "output_format": args.output_format,
+        "priority": args.priority,
+        "model": args.model,
+    }]}
+
+    process = None
+    try:
+        if args.url:
+            url = args.url.rstrip("/")
+        else:
+            print(f"Starting local server (fake GCS in {gcs_root}, {'stub' if args.stub else 'nnU-Net'} predictor)...")
+            process, url = start_server(gcs_root, args.stub, args.stub_latency, free_port(), args.startup_timeout)
+
+        print(f"Sending load to {url}/predict: concurrency={args.concurrency}, "
+              f"rate={args.rate or 'closed loop'}, requests={args.requests}, duration={args.duration}")
+        results, wall_time = run_load(url, payload, args.concurrency, args.rate, args.requests, args.duration, args.timeout)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if not args.gcs_root:
+            shutil.rmtree(gcs_root, ignore_errors=True)
+
+    summary = summarize(results, wall_time)
+    print("\nLoad Test Results:")
+    print("=" * 30)
+    for key, value in summary.items():
+        print(f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Filesystem-backed stand-in for the parts of google.cloud.storage used by the API.
+
+Blobs live at `<root>/<bucket>/<blob name>`. Enable it in app.py by setting
+NNUNET_LOCAL_GCS_ROOT, e.g. for load tests or offline runs without credentials.
+"""
+
+import os
+import shutil
+
+
+class PreconditionFailed(Exception):
+    """Raised like google.api_core.exceptions.PreconditionFailed when if_generation_match fails."""
+
+
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.path, name)
+
+    def exists(self, client=None):
+        return os.path.isfile(self.path)
+
+    def download_to_filename(self, filename):
+        if not self.exists():
+            raise FileNotFoundError(f"No such object: gs://{self.bucket.name}/{self.name}")
+        shutil.copyfile(self.path, filename)
+
+    def upload_from_filename(self, filename, if_generation_match=None):
+        with self.open("wb", if_generation_match=if_generation_match) as f, open(filename, "rb") as src:
+            shutil.copyfileobj(src, f)
+
+    def open(self, mode="rb", if_generation_match=None):
+        if mode == "rb":
+            if not self.exists():
+                raise FileNotFoundError(f"No such object: gs://{self.bucket.name}/{self.name}")
+            return open(self.path, "rb")
+        if mode != "wb":
+            raise ValueError(f"Unsupported mode '{mode}'")
+        return LocalBlobWriter(self, if_generation_match)
+
+
+class LocalBlobWriter:
+    """Writes to a temporary file, published as the blob on close so readers never see partial objects."""
+
+    def __init__(self, blob, if_generation_match=None):
+        self.blob = blob
+        self.if_generation_match = if_generation_match
+        os.makedirs(os.path.dirname(blob.path), exist_ok=True)
+        self.tmp_path = f"{blob.path}.{os.getpid()}.{id(self)}.tmp"
+        self.file = open(self.tmp_path, "wb")
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        if self.if_generation_match == 0:
+            # Create only if absent: link fails atomically if the object exists
+            try:
+                os.link(self.tmp_path, self.blob.path)
+            except FileExistsError:
+                raise PreconditionFailed(f"gs://{self.blob.bucket.name}/{self.blob.name} already exists")
+            finally:
+                os.remove(self.tmp_path)
+        else:
+            os.replace(self.tmp_path, self.blob.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            # Like an interrupted upload: nothing is published
+            self.file.close()
+            os.remove(self.tmp_path)
+            return False
+        self.close()
+        return False
+
+
+class LocalBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.path = os.path.join(client.root, name)
+
+    def blob(self, blob_name):
+        return LocalBlob(self, blob_name)
+
+
+class LocalStorageClient:
+    """Mimics google.cloud.storage.Client on a local directory."""
+
+    def __init__(self, root, project=None):
+        self.root = root
+        self.project = project
+        os.makedirs(root, exist_ok=True)
+
+    def bucket(self, bucket_name):
+        return LocalBucket(self, bucket_name)
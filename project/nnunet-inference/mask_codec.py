@@ -0,0 +1,218 @@
+"""
+Compact run-length encoding for segmentation masks.
+
+Edema masks are almost entirely background, so storing them as full-size
+NIfTI volumes wastes bandwidth and disk. This module stores a label mask as
+per-slice run-length encoded runs (runs never cross an axis-0 slice, so a
+single slice can be decoded on its own), zlib-compressed, behind a small
+header that keeps the original NIfTI header block. Conversion to and from
+NIfTI is loss-free: voxel labels, affine, zooms and header fields survive a
+round trip unchanged.
+
+Layout (little endian):
+    magic "NRLE" | version u8 | nifti kind u8 | ndim u8 | shape u32 * ndim
+    | header length u32 | NIfTI header block
+    | number of runs u64 | compressed payload length u64 | zlib payload
+
+The zlib payload holds, in order: the per-slice run offsets (u64, one per
+axis-0 slice plus one), the run values (u8) and the run lengths (u32).
+
+Usage:
+    python mask_codec.py to-rle   mask.nii.gz mask.rle
+    python mask_codec.py to-nifti mask.rle    mask.nii.gz
+"""
+
+import argparse
+import os
+import struct
+import zlib
+
+import nibabel as nib
+import numpy as np
+
+MAGIC = b"NRLE"
+VERSION = 1
+RLE_SUFFIX = ".rle"
+
+# Which NIfTI header class the stored block belongs to
+_HEADER_KINDS = {1: nib.Nifti1Header, 2: nib.Nifti2Header}
+
+
+def is_rle_path(path):
+    """True if `path` names an RLE mask file."""
+    return str(path).endswith(RLE_SUFFIX)
+
+
+def _runs(flat, slice_size):
+    """Returns run starts for `flat`, breaking runs at every slice boundary."""
+    n = flat.size
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    is_start = np.empty(n, dtype=bool)
+    is_start[0] = True
+    np.not_equal(flat[1:], flat[:-1], out=is_start[1:])
+    if slice_size > 0:
+        is_start[::slice_size] = True
+    return np.flatnonzero(is_start)
+
+
+def encode_mask(mask, header=None, affine=None, level=6):
+    """
+    Encodes an integer label mask into the compact RLE format.
+
+    Args:
+        mask (np.ndarray): Label volume, integer values in [0, 255]
+        header (nib.Nifti1Header, optional): Header to keep for loss-free NIfTI export
+        affine (np.ndarray, optional): Affine used when no header is given
+        level (int): zlib compression level
+
+    Returns:
+        bytes: Encoded mask
+    """
+    mask = np.asanyarray(mask)
+    if mask.ndim < 1:
+        raise ValueError("Mask must have at least one dimension")
+    if mask.size and (mask.min() < 0 or mask.max() > 255):
+        raise ValueError("Mask labels must fit in [0, 255]")
+    if mask.dtype.kind == "f" and mask.size and not np.array_equal(mask, np.round(mask)):
+        raise ValueError("Mask contains non-integer values")
+
+    if header is None:
+        header = nib.Nifti1Header()
+        header.set_data_shape(mask.shape)
+        header.set_data_dtype(np.uint8)
+        if affine is not None:
+            header.set_sform(affine, code=1)
+            header.set_qform(affine, code=1)
+    kind = 2 if isinstance(header, nib.Nifti2Header) else 1
+    if not isinstance(header, _HEADER_KINDS[kind]):
+        header = nib.Nifti1Header.from_header(header)
+    header_block = header.binaryblock
+
+    flat = np.ascontiguousarray(mask, dtype=np.uint8).reshape(-1)
+    slice_size = int(np.prod(mask.shape[1:], dtype=np.int64))
+    starts = _runs(flat, slice_size)
+    values = flat[starts]
+    lengths = np.diff(np.append(starts, flat.size)).astype("<u4")
+
+    # Run index at which each axis-0 slice begins
+    slice_starts = np.arange(mask.shape[0] + 1, dtype=np.int64) * slice_size
+    offsets = np.searchsorted(starts, slice_starts).astype("<u8")
+
+    payload = zlib.compress(offsets.tobytes() + values.tobytes() + lengths.tobytes(), level)
+
+    out = [
+        MAGIC,
+        struct.pack("<BBB", VERSION, kind, mask.ndim),
+        struct.pack(f"<{mask.ndim}I", *mask.shape),
+        struct.pack("<I", len(header_block)),
+        header_block,
+        struct.pack("<QQ", starts.size, len(payload)),
+        payload,
+    ]
+    return b"".join(out)
+
+
+def _parse(blob):
+    """Splits an encoded mask into (shape, header, offsets, values, lengths)."""
+    view = memoryview(blob)
+    if bytes(view[:4]) != MAGIC:
+        raise ValueError("Not an RLE mask (bad magic)")
+    version, kind, ndim = struct.unpack_from("<BBB", view, 4)
+    if version != VERSION:
+        raise ValueError(f"Unsupported RLE mask version: {version}")
+    pos = 7
+    shape = struct.unpack_from(f"<{ndim}I", view, pos)
+    pos += 4 * ndim
+    (header_len,) = struct.unpack_from("<I", view, pos)
+    pos += 4
+    header = _HEADER_KINDS[kind](binaryblock=bytes(view[pos:pos + header_len]))
+    pos += header_len
+    n_runs, payload_len = struct.unpack_from("<QQ", view, pos)
+    pos += 16
+    raw = zlib.decompress(view[pos:pos + payload_len])
+
+    n_offsets = shape[0] + 1
+    offsets = np.frombuffer(raw, dtype="<u8", count=n_offsets)
+    values = np.frombuffer(raw, dtype=np.uint8, count=n_runs, offset=8 * n_offsets)
+    lengths = np.frombuffer(raw, dtype="<u4", count=n_runs, offset=8 * n_offsets + n_runs)
+    return shape, header, offsets, values, lengths
+
+
+def decode_mask(blob):
+    """
+    Decodes an RLE mask.
+
+    Returns:
+        tuple: (uint8 label volume, NIfTI header)
+    """
+    shape, header, _, values, lengths = _parse(blob)
+    mask = np.repeat(values, lengths).reshape(shape)
+    return mask, header
+
+
+def decode_slice(blob, index):
+    """Decodes only axis-0 slice `index` of an RLE mask."""
+    shape, _, offsets, values, lengths = _parse(blob)
+    lo, hi = int(offsets[index]), int(offsets[index + 1])
+    return np.repeat(values[lo:hi], lengths[lo:hi]).reshape(shape[1:])
+
+
+def mask_to_nifti(mask, header):
+    """Builds a NIfTI image from a decoded mask, keeping the stored header as is."""
+    image_class = nib.Nifti2Image if isinstance(header, nib.Nifti2Header) else nib.Nifti1Image
+    data = mask.astype(header.get_data_dtype(), copy=False)
+    image = image_class(data, None, header=header)
+    # Keep the exact header; no rescaling of integer labels on save
+    image.header.set_slope_inter(*header.get_slope_inter())
+    return image
+
+
+def load_mask_image(path):
+    """Loads a mask from either an RLE file or a NIfTI file as a NIfTI image."""
+    if is_rle_path(path):
+        with open(path, "rb") as f:
+            mask, header = decode_mask(f.read())
+        return mask_to_nifti(mask, header)
+    return nib.load(str(path))
+
+
+def write_rle(path, mask, header=None, affine=None):
+    """Writes a mask to `path` in RLE format and returns the number of bytes written."""
+    blob = encode_mask(mask, header=header, affine=affine)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(blob)
+    os.replace(tmp_path, path)
+    return len(blob)
+
+
+def nifti_to_rle(src, dst):
+    """Converts a NIfTI mask to RLE. Returns the number of bytes written."""
+    image = nib.load(str(src))
+    return write_rle(dst, np.asanyarray(image.dataobj), header=image.header)
+
+
+def rle_to_nifti(src, dst):
+    """Converts an RLE mask back to NIfTI."""
+    nib.save(load_mask_image(src), str(dst))
+    return dst
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert segmentation masks between NIfTI and RLE")
+    parser.add_argument("command", choices=["to-rle", "to-nifti"])
+    parser.add_argument("src", help="Input file")
+    parser.add_argument("dst", help="Output file")
+    args = parser.parse_args()
+
+    if args.command == "to-rle":
+        written = nifti_to_rle(args.src, args.dst)
+        print(f"{args.src} ({os.path.getsize(args.src)} bytes) -> {args.dst} ({written} bytes)")
+    else:
+        rle_to_nifti(args.src, args.dst)
+        print(f"{args.src} -> {args.dst}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Registry of the trained nnU-Net models served by the API.
+
+Models are trained model folders (containing plans.json and dataset.json) below
+a models root, identified by their relative path, e.g. "Dataset001_LUMIERE" or
+"Dataset002_X/nnUNetTrainer__nnUNetPlans__3d_fullres". Predictors are loaded
+lazily on first use and evicted least recently used first when the loaded
+models exceed the memory budget. Jobs already holding a predictor keep it alive
+until they finish, so eviction never breaks a request in flight.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def estimate_model_bytes(model_path, folds):
+    """Approximates the memory of a loaded model by the size of its checkpoints."""
+    total = 0
+    for fold in folds:
+        fold_dir = os.path.join(model_path, f"fold_{fold}")
+        for name in ("checkpoint_final.pth", "checkpoint_best.pth"):
+            checkpoint = os.path.join(fold_dir, name)
+            if os.path.isfile(checkpoint):
+                total += os.path.getsize(checkpoint)
+                break
+    return total
+
+
+class ModelRegistry:
+    def __init__(self, models_root, loader, memory_budget_bytes, default_model, folds=(0,), on_evict=None):
+        """
+        Args:
+            models_root (str): Folder holding the trained model folders
+            loader (callable): loader(model_path, folds) -> predictor
+            memory_budget_bytes (int): Budget for all loaded models; the most recent model is always kept
+            default_model (str): Model used when a request does not name one
+            folds (tuple): Folds to load for every model
+            on_evict (callable, optional): Called with an evicted predictor, e.g. to release GPU memory
+        """
+        self.models_root = os.path.abspath(models_root)
+        self.loader = loader
+        self.memory_budget_bytes = memory_budget_bytes
+        self.default_model = default_model
+        self.folds = tuple(folds)
+        self.on_evict = on_evict
+        self._loaded = OrderedDict() # name -> (predictor, size in bytes, loaded at), least recently used first
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def resolve(self, name=None):
+        """Validates a model name and returns (name, absolute model path). Raises ValueError if unknown."""
+        name = (name or self.default_model).strip("/")
+        model_path = os.path.abspath(os.path.join(self.models_root, name))
+        if os.path.commonpath([model_path, self.models_root]) != self.models_root or model_path == self.models_root:
+            raise ValueError(f"Invalid model name '{name}'")
+        if not os.path.isfile(os.path.join(model_path, "plans.json")):
+            raise ValueError(f"Unknown model '{name}', available: {self.available()}")
+        return name, model_path
+
+    def available(self):
+        """Model folders below the models root (up to two levels deep)."""
+        models = []
+        if not os.path.isdir(self.models_root):
+            return models
+        for entry in sorted(os.listdir(self.models_root)):
+            path = os.path.join(self.models_root, entry)
+            if os.path.isfile(os.path.join(path, "plans.json")):
+                models.append(entry)
+            elif os.path.isdir(path):
+                models.extend(f"{entry}/{sub}" for sub in sorted(os.listdir(path))
+                              if os.path.isfile(os.path.join(path, sub, "plans.json")))
+        return models
+
+    def get(self, name=None):
+        """Returns the predictor for `name`, loading it (and evicting others) if needed."""
+        name, model_path = self.resolve(name)
+        with self._lock:
+            if name in self._loaded:
+                self._loaded.move_to_end(name)
+                return self._loaded[name][0]
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        # One thread loads a given model; others asking for it wait, others keep being served
+        with load_lock:
+            with self._lock:
+                if name in self._loaded:
+                    self._loaded.move_to_end(name)
+                    return self._loaded[name][0]
+            print(f"Loading model {name} from {model_path}...")
+            start = time.perf_counter()
+            predictor = self.loader(model_path, self.folds)
+            size = estimate_model_bytes(model_path, self.folds)
+            print(f"Model {name} loaded in {time.perf_counter() - start:.1f}s ({size / 2**20:.0f} MB)")
+            with self._lock:
+                self._loaded[name] = (predictor, size, time.time())
+                evicted = self._evict_over_budget()
+        for evicted_name, evicted_predictor in evicted:
+            print(f"Evicted model {evicted_name} (memory budget {self.memory_budget_bytes / 2**20:.0f} MB)")
+            if self.on_evict is not None:
+                self.on_evict(evicted_predictor)
+        return predictor
+
+    def _evict_over_budget(self):
+        evicted = []
+        while len(self._loaded) > 1 and sum(size for _, size, _ in self._loaded.values()) > self.memory_budget_bytes:
+            evicted_name, (evicted_predictor, _, _) = self._loaded.popitem(last=False)
+            evicted.append((evicted_name, evicted_predictor))
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            loaded = [
+                {"model": name, "memory_mb": round(size / 2**20, 1), "loaded_at": loaded_at}
+                for name, (_, size, loaded_at) in self._loaded.items()
+            ]
+        return {
+            "default_model": self.default_model,
+            "loaded": loaded[::-1], # Most recently used first
+            "available": self.available(),
+            "memory_used_mb": round(sum(m["memory_mb"] for m in loaded), 1),
+            "memory_budget_mb": round(self.memory_budget_bytes / 2**20, 1),
+        }
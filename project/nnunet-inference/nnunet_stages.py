@@ -0,0 +1,186 @@
+"""
+nnU-Net inference split into the stages run by pipeline.py.
+
+nnUNetPredictor.predict_from_files preprocesses, predicts and exports a folder in
+one call. Here the same steps are exposed separately so preprocessing and export
+of one request can run while the network processes another.
+"""
+
+import itertools
+
+import numpy as np
+import torch
+from acvl_utils.cropping_and_padding.bounding_boxes import bounding_box_to_slice
+from nnunetv2.inference.export_prediction import export_prediction_from_logits
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+
+from uncertainty import lesion_uncertainty, quantize
+
+
+class MirrorUncertaintyPredictor(nnUNetPredictor):
+    """
+    nnUNetPredictor that also measures the disagreement between its mirrored passes.
+
+    The logits are unchanged. While `collect_uncertainty` is set, every tile's
+    mirrored passes are also reduced to a per-voxel disagreement (see
+    uncertainty.py) and averaged over overlapping tiles and folds, in the
+    preprocessed geometry. No extra forward pass runs.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.collect_uncertainty = False
+        self._tile_slicers = None
+        self._uncertainty_sum = None
+        self._uncertainty_count = None
+        self._fold_uncertainties = []
+
+    def predict_sliding_window_return_logits(self, input_image):
+        if not self.collect_uncertainty:
+            return super().predict_sliding_window_return_logits(input_image)
+        logits = super().predict_sliding_window_return_logits(input_image)
+        # Tiles were taken from the padded image; undo nnU-Net's centered padding
+        uncertainty = self._uncertainty_sum / torch.clamp(self._uncertainty_count, min=1)
+        revert = tuple(
+            slice((padded - original) // 2, (padded - original) // 2 + original)
+            for padded, original in zip(uncertainty.shape, input_image.shape[1:])
+        )
+        self._fold_uncertainties.append(uncertainty[revert].float().cpu())
+        self._uncertainty_sum = self._uncertainty_count = self._tile_slicers = None
+        return logits
+
+    def _internal_predict_sliding_window_return_logits(self, data, slicers, do_on_device=True):
+        if self.collect_uncertainty:
+            # Tiles are predicted in slicer order; remember where each one goes
+            results_device = self.device if do_on_device else torch.device('cpu')
+            self._tile_slicers = iter(slicers)
+            self._uncertainty_sum = torch.zeros(data.shape[1:], dtype=torch.float32, device=results_device)
+            self._uncertainty_count = torch.zeros(data.shape[1:], dtype=torch.float32, device=results_device)
+        return super()._internal_predict_sliding_window_return_logits(data, slicers, do_on_device)
+
+    def _internal_maybe_mirror_and_predict(self, x):
+        mirror_axes = self.allowed_mirroring_axes if self.use_mirroring else None
+        if not self.collect_uncertainty or self._tile_slicers is None or not mirror_axes:
+            return super()._internal_maybe_mirror_and_predict(x)
+
+        # Same passes as nnUNetPredictor, keeping running moments of the class probabilities
+        mirror_axes = [m + 2 for m in mirror_axes]
+        axes_combinations = [()] + [
+            c for i in range(len(mirror_axes)) for c in itertools.combinations(mirror_axes, i + 1)
+        ]
+        prediction = prob_sum = prob_sq_sum = None
+        for axes in axes_combinations:
+            logits = self.network(torch.flip(x, axes)) if axes else self.network(x)
+            if axes:
+                logits = torch.flip(logits, axes)
+            probabilities = self.label_manager.apply_inference_nonlin(logits[0].float())
+            if prediction is None:
+                prediction, prob_sum, prob_sq_sum = logits, probabilities, probabilities ** 2
+            else:
+                prediction += logits
+                prob_sum += probabilities
+                prob_sq_sum += probabilities ** 2
+        n = len(axes_combinations)
+        prediction /= n
+
+        variance = torch.clamp(prob_sq_sum / n - (prob_sum / n) ** 2, min=0).sum(0)
+        disagreement = torch.clamp(2 * torch.sqrt(variance / 2), max=1)
+        sl = next(self._tile_slicers)
+        self._uncertainty_sum[sl[1:]] += disagreement.to(self._uncertainty_sum.device)
+        self._uncertainty_count[sl[1:]] += 1
+        return prediction
+
+    def predict_logits_and_uncertainty(self, data):
+        """Returns (logits, uncertainty) for preprocessed data; uncertainty is None without mirroring."""
+        self._fold_uncertainties = []
+        self.collect_uncertainty = True
+        try:
+            logits = self.predict_logits_from_preprocessed_data(data)
+        finally:
+            self.collect_uncertainty = False
+        uncertainty = None
+        if self._fold_uncertainties:
+            uncertainty = torch.stack(self._fold_uncertainties).mean(0).numpy()
+        self._fold_uncertainties = []
+        return logits, uncertainty
+
+
+class NnUNetStages:
+    def __init__(self, model_path, folds=(0,), device=None, use_mirroring=True):
+        self.predictor = MirrorUncertaintyPredictor(
+            tile_step_size=0.5,
+            use_gaussian=True,
+            use_mirroring=use_mirroring,
+            device=device or torch.device('cuda' if torch.cuda.is_available() else 'cpu'),
+            verbose=False,
+        )
+        self.predictor.initialize_from_trained_model_folder(
+            model_training_output_dir=model_path,
+            use_folds=folds,
+        )
+        self.device = self.predictor.device
+        self.file_ending = self.predictor.dataset_json["file_ending"]
+
+    def preprocess(self, input_file):
+        """Reads, crops, resamples and normalizes one volume. Returns (data, properties)."""
+        p = self.predictor
+        preprocessor = p.configuration_manager.preprocessor_class(verbose=False)
+        data, _, properties = preprocessor.run_case(
+            [input_file], None, p.plans_manager, p.configuration_manager, p.dataset_json
+        )
+        return torch.from_numpy(data).to(dtype=torch.float32).contiguous(), properties
+
+    def predict(self, data, with_uncertainty=False):
+        """
+        Runs the sliding-window network prediction.
+
+        Returns:
+            tuple: (logits on the CPU, disagreement map in the preprocessed geometry or None)
+        """
+        with torch.no_grad():
+            if with_uncertainty:
+                logits, uncertainty = self.predictor.predict_logits_and_uncertainty(data)
+                return logits.cpu(), uncertainty
+            return self.predictor.predict_logits_from_preprocessed_data(data).cpu(), None
+
+    def export(self, logits, properties, output_file_truncated, uncertainty=None):
+        """
+        Resamples the logits back to the input geometry and writes `output_file_truncated` + file ending.
+        With an uncertainty map, also writes it (uint8 percent) next to the mask and scores each lesion.
+
+        Returns:
+            dict: mask_file, and uncertainty_file and lesion_uncertainty if an uncertainty map was given
+        """
+        p = self.predictor
+        export_prediction_from_logits(
+            logits, properties, p.configuration_manager, p.plans_manager, p.dataset_json,
+            output_file_truncated, save_probabilities=False,
+        )
+        result = {"mask_file": output_file_truncated + self.file_ending}
+        if uncertainty is None:
+            return result
+
+        reverted = quantize(self._revert_geometry(uncertainty, properties))
+        reader_writer = p.plans_manager.image_reader_writer_class()
+        uncertainty_file = output_file_truncated + "_uncertainty" + self.file_ending
+        reader_writer.write_seg(reverted, uncertainty_file, properties)
+        segmentation, _ = reader_writer.read_seg(result["mask_file"])
+        result["uncertainty_file"] = uncertainty_file
+        result["lesion_uncertainty"] = lesion_uncertainty(segmentation[0], reverted)
+        return result
+
+    def _revert_geometry(self, volume, properties):
+        """Maps a map in the preprocessed geometry back to the input image, as nnU-Net does for probabilities."""
+        plans_manager, configuration_manager = self.predictor.plans_manager, self.predictor.configuration_manager
+        spacing_transposed = [properties['spacing'][i] for i in plans_manager.transpose_forward]
+        shape = properties['shape_after_cropping_and_before_resampling']
+        current_spacing = configuration_manager.spacing if len(configuration_manager.spacing) == len(shape) \
+            else [spacing_transposed[0], *configuration_manager.spacing]
+        resampled = configuration_manager.resampling_fn_probabilities(
+            volume[None], shape, current_spacing, spacing_transposed
+        )[0]
+        if isinstance(resampled, torch.Tensor):
+            resampled = resampled.numpy()
+        full = np.zeros(properties['shape_before_cropping'], dtype=np.float32)
+        full[bounding_box_to_slice(properties['bbox_used_for_cropping'])] = resampled
+        return full.transpose(plans_manager.transpose_backward)
@@ -0,0 +1,119 @@
+"""
+Three-stage inference pipeline: preprocessing workers -> inference worker -> export workers.
+
+Download and resampling of one request overlap with network inference of
+another, and export/upload overlaps with both, so under sustained load the
+throughput approaches the inference-only rate. Stages are connected by bounded
+priority queues (scheduler.py): when the inference worker falls behind,
+preprocessing pauses instead of piling up volumes in memory, and at every stage
+urgent jobs are served first. Urgent jobs are not held back by the bounds: a
+stage only starts a non-urgent job while the next queue has room, so its workers
+stay free for an urgent one, which then goes straight into the next queue.
+"""
+
+import threading
+import traceback
+
+from scheduler import AGING_SECONDS, DEFAULT_PRIORITY, Job, PriorityQueues
+
+
+class InferencePipeline:
+    """
+    Runs `preprocess`, `infer` and `export` on a payload, each stage on its own workers.
+
+    Each stage function takes the payload and mutates or returns it; the value
+    returned by `export` resolves the future returned by `submit`. `cleanup` is
+    called once per payload, whether it succeeded or failed.
+    """
+
+    def __init__(self, preprocess, infer, export, cleanup=None,
+                 preprocess_workers=2, export_workers=2, depth=2, aging_seconds=AGING_SECONDS):
+        self.stages = [
+            ("preprocess", preprocess, preprocess_workers),
+            ("inference", infer, 1), # One worker owns the GPU
+            ("export", export, export_workers),
+        ]
+        self.cleanup = cleanup
+        # Requests wait unbounded for preprocessing; queues between stages are bounded.
+        # One condition for all queues: a stage waiting for room downstream is woken when it frees up
+        cond = threading.Condition()
+        self.queues = [
+            PriorityQueues(aging_seconds=aging_seconds, cond=cond),
+            PriorityQueues(aging_seconds=aging_seconds, maxsize=depth, cond=cond),
+            PriorityQueues(aging_seconds=aging_seconds, maxsize=depth, cond=cond),
+        ]
+        self.busy = {name: 0 for name, _, _ in self.stages}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        if self._threads:
+            return
+        for index, (name, fn, workers) in enumerate(self.stages):
+            for i in range(workers):
+                thread = threading.Thread(target=self._worker, args=(index,), name=f"{name}-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        # Close stage by stage so jobs already in flight drain through the pipeline
+        for index, queue in enumerate(self.queues):
+            queue.close()
+            for thread in self._threads:
+                if thread.name.startswith(self.stages[index][0]):
+                    thread.join()
+        self._threads = []
+
+    def submit(self, payload, priority=DEFAULT_PRIORITY):
+        """Queues `payload` for preprocessing and returns a concurrent.futures.Future for its result."""
+        job = Job(payload, priority)
+        self.queues[0].put(job)
+        return job.future
+
+    def _worker(self, index):
+        name, fn, _ = self.stages[index]
+        is_last = index == len(self.stages) - 1
+        # Non-urgent jobs are only started when their result can be handed on
+        admit = None if is_last else (lambda job: job.rank == 0 or not self.queues[index + 1].full())
+        while True:
+            job = self.queues[index].get(admit=admit)
+            if job is None:
+                return
+            if index == 0 and not job.future.set_running_or_notify_cancel():
+                self._cleanup(job)
+                continue
+            with self._lock:
+                self.busy[name] += 1
+            try:
+                result = fn(job.payload)
+            except BaseException as e:
+                print(f"{name} stage failed: {e}")
+                print(traceback.format_exc())
+                job.future.set_exception(e)
+                self._cleanup(job)
+                continue
+            finally:
+                with self._lock:
+                    self.busy[name] -= 1
+
+            if is_last:
+                job.future.set_result(result)
+                self._cleanup(job)
+            else:
+                # Same job object moves on, keeping its priority and submission time for aging
+                self.queues[index + 1].put(job)
+
+    def _cleanup(self, job):
+        if self.cleanup is not None:
+            try:
+                self.cleanup(job.payload)
+            except Exception as e:
+                print(f"Cleanup failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            busy = dict(self.busy)
+        return {
+            name: {"queued": self.queues[index].depths(), "busy": busy[name]}
+            for index, (name, _, _) in enumerate(self.stages)
+        }
@@ -0,0 +1,126 @@
+"""
+Priority scheduling of inference jobs.
+
+Each job is one volume. Jobs wait in one FIFO queue per priority class in front
+of every pipeline stage (pipeline.py), so a long batch request is naturally
+preemptible between volumes: an urgent job submitted meanwhile is picked up
+as soon as the volume currently in a stage leaves it.
+
+Lower classes age while they wait so they are not starved by a steady stream of
+normal traffic, but aging never lets them overtake an urgent job.
+
+Bounded queues only hold back non-urgent jobs: an urgent job is queued at once
+even when the queue is full, so it never waits behind batch volumes for a slot
+between two stages. Queues of one pipeline can share a condition, so that a
+stage only takes non-urgent jobs while the next queue has room (`get(admit=...)`):
+its workers then stay free for an urgent job instead of blocking with batch
+volumes in hand.
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+# Priority classes, most urgent first
+PRIORITIES = {"urgent": 0, "normal": 1, "batch": 2}
+DEFAULT_PRIORITY = "normal"
+
+# Seconds of waiting needed to gain one priority class
+AGING_SECONDS = 120.0
+
+
+class Job:
+    """A unit of work in a priority queue; `payload` is whatever the consumer needs."""
+
+    __slots__ = ("payload", "future", "priority", "rank", "submitted_at", "seq")
+
+    def __init__(self, payload, priority=DEFAULT_PRIORITY, future=None):
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority '{priority}', expected one of {list(PRIORITIES)}")
+        self.payload = payload
+        self.future = future if future is not None else Future()
+        self.priority = priority
+        self.rank = PRIORITIES[priority]
+        self.submitted_at = time.monotonic()
+        self.seq = 0
+
+    def effective_rank(self, now, aging_seconds):
+        if self.rank == 0:
+            return 0.0
+        # Aged jobs can reach the "normal" class but never the urgent one
+        return max(self.rank - (now - self.submitted_at) / aging_seconds, 1.0)
+
+
+class PriorityQueues:
+    """Per-priority FIFO queues with aging. `get` blocks until a job is available."""
+
+    def __init__(self, aging_seconds=AGING_SECONDS, maxsize=0, cond=None):
+        self.aging_seconds = aging_seconds
+        self.maxsize = maxsize
+        self._queues = {priority: deque() for priority in PRIORITIES}
+        # Shared between the queues of a pipeline, so a wait on one queue sees changes of the others
+        self._cond = cond if cond is not None else threading.Condition()
+        self._seq = 0
+        self._closed = False
+
+    def __len__(self):
+        with self._cond:
+            return sum(len(q) for q in self._queues.values())
+
+    def put(self, job):
+        """Queues `job` in its priority class, blocking while the queues are full unless the job is urgent."""
+        with self._cond:
+            # Urgent jobs go past the bound; at most one per worker of the previous stage is in hand at a time
+            while (job.rank > 0 and self.maxsize and sum(len(q) for q in self._queues.values()) >= self.maxsize
+                   and not self._closed):
+                self._cond.wait()
+            if self._closed:
+                raise RuntimeError("Queue is closed")
+            self._seq += 1
+            job.seq = self._seq
+            self._queues[job.priority].append(job)
+            self._cond.notify_all()
+
+    def full(self):
+        """Whether a non-urgent `put` would block."""
+        with self._cond:
+            return bool(self.maxsize) and sum(len(q) for q in self._queues.values()) >= self.maxsize
+
+    def _pop_best(self, admit=None):
+        now = time.monotonic()
+        heads = [q[0] for q in self._queues.values() if q and (admit is None or admit(q[0]))]
+        if not heads:
+            return None
+        best = min(heads, key=lambda job: (job.effective_rank(now, self.aging_seconds), job.seq))
+        return self._queues[best.priority].popleft()
+
+    def get(self, timeout=None, admit=None):
+        """
+        Returns the next job by effective priority, or None on timeout or once closed and empty.
+
+        `admit(job)`, if given, is checked under the queue's condition; jobs it rejects stay queued
+        until a change notified on that condition admits them.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                job = self._pop_best(admit)
+                if job is not None:
+                    self._cond.notify_all()
+                    return job
+                if self._closed and not len(self):
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def depths(self):
+        with self._cond:
+            return {priority: len(q) for priority, q in self._queues.items()}
@@ -0,0 +1,41 @@
+"""
+Stand-in for the nnU-Net stages (nnunet_stages.py), used to load test the serving path without a GPU or model weights.
+
+Preprocessing and export do real file I/O; the prediction step sleeps for a
+configurable time to simulate the network, then thresholds the input volume.
+Enable it in app.py by setting NNUNET_STUB_PREDICTOR=1 (and optionally
+NNUNET_STUB_LATENCY in seconds).
+"""
+
+import time
+
+import nibabel as nib
+import numpy as np
+
+from uncertainty import lesion_uncertainty
+
+
+class StubPredictor:
+    def __init__(self, latency=0.5):
+        self.latency = latency
+        self.device = "stub"
+        self.file_ending = ".nii.gz"
+
+    def preprocess(self, input_file):
+        image = nib.load(input_file)
+        return np.asanyarray(image.dataobj), {"affine": image.affine}
+
+    def predict(self, data, with_uncertainty=False):
+        time.sleep(self.latency)
+        mask = (data > np.percentile(data, 99)).astype(np.uint8)
+        # No mirrored passes to compare: the stub is always certain
+        return mask, np.zeros(mask.shape, dtype=np.uint8) if with_uncertainty else None
+
+    def export(self, logits, properties, output_file_truncated, uncertainty=None):
+        result = {"mask_file": output_file_truncated + self.file_ending}
+        nib.save(nib.Nifti1Image(logits, properties["affine"]), result["mask_file"])
+        if uncertainty is not None:
+            result["uncertainty_file"] = output_file_truncated + "_uncertainty" + self.file_ending
+            nib.save(nib.Nifti1Image(uncertainty, properties["affine"]), result["uncertainty_file"])
+            result["lesion_uncertainty"] = lesion_uncertainty(logits, uncertainty)
+        return result
@@ -1,10 +1,15 @@
 import os
 import time
 import json
+import hashlib
 import requests
 import argparse
 from google.cloud import storage
 from google.cloud import aiplatform 
+from google.api_core.exceptions import PreconditionFailed
+
+from mask_codec import RLE_SUFFIX, is_rle_path, rle_to_nifti, nifti_to_rle
+from gzip_stream import DEFAULT_LEVEL, compress_file
 
 # --- Vertex AI Configuration ---
 PROJECT_ID = 'gemma-hcls25par-722'  
@@ -20,18 +25,62 @@ OUTPUT_BUCKET = "nnunet-output-bucket"
 # GCS_INPUT_BLOB_NAME = f"tests/{os.path.basename(LOCAL_FILE_PATH)}"
 GCS_OUTPUT_PREFIX = "test-results/" 
 
+# Inputs are content addressed: gs://INPUT_BUCKET/GCS_INPUT_PREFIX/<sha256><extension>
+GCS_INPUT_PREFIX = "inputs/sha256/"
+
 # LOCAL_DOWNLOAD_DIR = "downloaded_inference_results"
 
 # --- GCS Utility Functions ---
-def upload_to_gcs(local_path, gcs_uri):
-    """Uploads a local file to GCS."""
+def file_sha256(local_path, chunk_size=8 * 1024 * 1024):
+    """SHA-256 of a file's content, as a hex string."""
+    digest = hashlib.sha256()
+    with open(local_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def nifti_extension(path):
+    """File extension, keeping the double '.nii.gz' extension whole."""
+    return ".nii.gz" if path.endswith(".nii.gz") else os.path.splitext(path)[1]
+
+def upload_to_gcs_if_absent(local_path, gcs_uri, compress_level=None, compress_threads=None):
+    """
+    Uploads a local file to a content-addressed GCS URI unless an object already exists there.
+    Safe under concurrency: the upload only creates the object if it does not exist yet, and
+    losing that race is fine since the existing object has the same content.
+
+    Args:
+        local_path (str): File to upload
+        gcs_uri (str): Destination URI
+        compress_level (int, optional): If given, gzip the file on the fly at this level while uploading
+        compress_threads (int, optional): Compression threads, defaults to the number of CPUs
+
+    Returns:
+        bool: True if the file was uploaded, False if it was already present
+    """
     bucket_name, blob_name = gcs_uri.replace("gs://", "").split("/", 1)
     storage_client = storage.Client(project=PROJECT_ID) 
+    blob = storage_client.bucket(bucket_name).blob(blob_name)
+    if blob.exists():
+        print(f"{gcs_uri} already present, skipping upload.")
+        return False
     print(f"Uploading {local_path} to {gcs_uri}...")
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    blob.upload_from_filename(local_path)
+    try:
+        if compress_level is None:
+            blob.upload_from_filename(local_path, if_generation_match=0)
+        else:
+            # Compressed blocks go straight into the upload, no temporary .nii.gz
+            start = time.perf_counter()
+            with blob.open("wb", if_generation_match=0) as f:
+                compressed_size = compress_file(local_path, f, level=compress_level, threads=compress_threads)
+            original_size = os.path.getsize(local_path)
+            print(f"Compressed {original_size} to {compressed_size} bytes "
+                  f"({original_size / max(compressed_size, 1):.1f}x) in {time.perf_counter() - start:.1f}s")
+    except PreconditionFailed:
+        print(f"{gcs_uri} was uploaded concurrently, skipping upload.")
+        return False
     print("Upload complete.")
+    return True
 
 def download_from_gcs(gcs_uri, local_path):
     """Downloads a file from GCS to a local path."""
@@ -56,12 +105,35 @@ if __name__ == "__main__":
     parser.add_argument('--output_file', 
                        default="../application/mri/0_seg/mri_file.nii",
                        help='Output prefix for storing inference results (default: ../application/mri/0_seg/mri_file.nii)')
+    parser.add_argument('--output_format',
+                       choices=['nifti', 'rle'],
+                       default='nifti',
+                       help='Mask format returned by the endpoint: nifti (.nii.gz) or rle (compact run-length encoding, default: nifti)')
+    parser.add_argument('--uncertainty',
+                       action='store_true',
+                       help='Also fetch the mirroring disagreement map and per-lesion uncertainty (saved next to the output file)')
+    parser.add_argument('--compress_level',
+                       type=int,
+                       choices=range(0, 10),
+                       default=DEFAULT_LEVEL,
+                       help=f'gzip level used to compress .nii inputs while uploading, 1 (fastest) to 9 (smallest) (default: {DEFAULT_LEVEL})')
+    parser.add_argument('--compress_threads',
+                       type=int,
+                       default=None,
+                       help='Threads used for compression (default: number of CPUs)')
+    parser.add_argument('--no_compress',
+                       action='store_true',
+                       help='Upload .nii inputs uncompressed')
     
     args = parser.parse_args()
     
     # Use the parsed arguments
     INPUT_FILE = args.input_file
     OUTPUT_FILE = args.output_file
+    OUTPUT_FORMAT = args.output_format
+    RETURN_UNCERTAINTY = args.uncertainty
+    # Inputs already in .nii.gz are uploaded as they are
+    COMPRESS = not args.no_compress and not INPUT_FILE.endswith(".gz")
     
     # Update GCS blob name based on the actual file path
     # GCS_INPUT_BLOB_NAME = f"tests/{os.path.basename(LOCAL_FILE_PATH)}"
@@ -71,8 +143,16 @@ if __name__ == "__main__":
 
 
 
-    # 1. Upload the test file to GCS
-    upload_to_gcs(INPUT_FILE, f"gs://{INPUT_BUCKET}/{INPUT_FILE}")
+    # 1. Upload the input to GCS, named by its content hash so repeated submissions upload nothing
+    #    and two patients' mri_file.nii never collide. The hash is of the uncompressed volume.
+    input_hash = file_sha256(INPUT_FILE)
+    input_extension = ".nii.gz" if COMPRESS else nifti_extension(INPUT_FILE)
+    input_gcs_uri = f"gs://{INPUT_BUCKET}/{GCS_INPUT_PREFIX}{input_hash}{input_extension}"
+    upload_to_gcs_if_absent(
+        INPUT_FILE, input_gcs_uri,
+        compress_level=args.compress_level if COMPRESS else None,
+        compress_threads=args.compress_threads,
+    )
 
     # --- 2. Send the request to the API deployed on Vertex AI ---
     print(f"\nInitializing Vertex AI client for project {PROJECT_ID} in region {REGION}...")
@@ -82,8 +162,11 @@ if __name__ == "__main__":
 
     instances = [
         {
-            "input_gcs_uri": f"gs://{INPUT_BUCKET}/{INPUT_FILE}",
-            "output_gcs_prefix": f"gs://{OUTPUT_BUCKET}/{GCS_OUTPUT_PREFIX}"
+            "input_gcs_uri": input_gcs_uri,
+            # Outputs are keyed by the same hash
+            "output_gcs_prefix": f"gs://{OUTPUT_BUCKET}/{GCS_OUTPUT_PREFIX}{input_hash}/",
+            "output_format": OUTPUT_FORMAT,
+            "return_uncertainty": RETURN_UNCERTAINTY,
         }
     ]
 
@@ -105,7 +188,11 @@ if __name__ == "__main__":
             if result.get("status") == "success" and "output_gcs_uris" in result:
                 print(f"\n--- Downloading output files to {OUTPUT_FILE} ---")
                 
-                for gcs_output_uri in result["output_gcs_uris"]:
+                # Only the mask is of interest; nnU-Net also writes plans/dataset json files
+                mask_uris = [uri for uri in result["output_gcs_uris"] if uri.endswith((".nii.gz", ".nii", RLE_SUFFIX))]
+                uncertainty_uris = [uri for uri in mask_uris if "_uncertainty." in os.path.basename(uri)]
+                mask_uris = [uri for uri in mask_uris if uri not in uncertainty_uris]
+                for gcs_output_uri in mask_uris:
 
                     # if GCS_OUTPUT_PREFIX in gcs_output_uri:
 
@@ -121,9 +208,27 @@ if __name__ == "__main__":
 
                     # os.makedirs(os.path.dirname(local_output_path_full), exist_ok=True)
                     
-                    # Download output file
-                    download_from_gcs(gcs_output_uri, OUTPUT_FILE)
+                    # Download output file, converting if the local file expects the other format
+                    if is_rle_path(gcs_output_uri) == is_rle_path(OUTPUT_FILE):
+                        download_from_gcs(gcs_output_uri, OUTPUT_FILE)
+                    else:
+                        downloaded_file = OUTPUT_FILE + (RLE_SUFFIX if is_rle_path(gcs_output_uri) else ".nii.gz")
+                        download_from_gcs(gcs_output_uri, downloaded_file)
+                        if is_rle_path(downloaded_file):
+                            rle_to_nifti(downloaded_file, OUTPUT_FILE)
+                        else:
+                            nifti_to_rle(downloaded_file, OUTPUT_FILE)
+                        os.remove(downloaded_file)
                 
+                # Uncertainty map and per-lesion scores go next to the mask
+                output_dir = os.path.dirname(OUTPUT_FILE)
+                for gcs_output_uri in uncertainty_uris:
+                    extension = RLE_SUFFIX if is_rle_path(gcs_output_uri) else ".nii.gz"
+                    download_from_gcs(gcs_output_uri, os.path.join(output_dir, "uncertainty" + extension))
+                if result.get("lesion_uncertainty") is not None:
+                    with open(os.path.join(output_dir, "lesion_uncertainty.json"), "w") as f:
+                        json.dump(result["lesion_uncertainty"], f, indent=2)
+
                 print("All output files downloaded successfully.")
             else:
                 print("No output URIs found or prediction was not successful.")
@@ -0,0 +1,68 @@
+"""
+Voxel-wise and per-lesion uncertainty from test-time augmentation passes.
+
+With mirroring enabled nnU-Net runs every tile through the network once per
+mirror combination and averages the results. The disagreement between those
+passes is a free uncertainty estimate: nnunet_stages.py collects it during the
+existing passes (no extra forward pass), and this module turns the resulting
+map into a compact uint8 volume and per-lesion scores.
+
+Disagreement of a voxel is 2 * sqrt(sum_c var_k(p_kc) / 2), where p_kc is the
+probability of class c in pass k. For a two-class mask this is twice the
+standard deviation of the edema probability across passes, in [0, 1].
+"""
+
+import numpy as np
+from scipy.ndimage import label
+
+# The exported map stores disagreement in percent (uint8, 0-100)
+UNCERTAINTY_SCALE = 100
+# Lesions whose mean disagreement exceeds this are flagged as low confidence
+LOW_CONFIDENCE_THRESHOLD = 0.2
+
+
+def quantize(uncertainty):
+    """Float disagreement in [0, 1] -> uint8 percent."""
+    return np.round(np.clip(uncertainty, 0, 1) * UNCERTAINTY_SCALE).astype(np.uint8)
+
+
+def lesion_uncertainty(segmentation, uncertainty):
+    """
+    Scores each connected lesion of `segmentation` with the disagreement of its voxels.
+
+    Args:
+        segmentation (np.ndarray): Label mask, lesions are voxels > 0
+        uncertainty (np.ndarray): Disagreement map of the same shape, float in [0, 1] or uint8 percent
+
+    Returns:
+        list: One dict per lesion (label order of scipy.ndimage.label) with voxel count,
+              mean and max disagreement and a low-confidence flag
+    """
+    labels, num_lesions = label(segmentation > 0)
+    if num_lesions == 0:
+        return []
+
+    # Only lesion voxels matter; work on them alone
+    foreground = np.flatnonzero(labels)
+    lesion_labels = labels.ravel()[foreground]
+    values = uncertainty.ravel()[foreground].astype(np.float64)
+    if uncertainty.dtype == np.uint8:
+        values /= UNCERTAINTY_SCALE
+
+    voxels = np.bincount(lesion_labels, minlength=num_lesions + 1)
+    sums = np.bincount(lesion_labels, weights=values, minlength=num_lesions + 1)
+    order = np.argsort(lesion_labels, kind="stable")
+    starts = np.concatenate(([0], np.cumsum(voxels[1:])[:-1]))
+    maxima = np.maximum.reduceat(values[order], starts)
+
+    scores = []
+    for lesion in range(1, num_lesions + 1):
+        mean = float(sums[lesion] / voxels[lesion])
+        scores.append({
+            "lesion": lesion,
+            "voxels": int(voxels[lesion]),
+            "mean_disagreement": round(mean, 4),
+            "max_disagreement": round(float(maxima[lesion - 1]), 4),
+            "low_confidence": mean > LOW_CONFIDENCE_THRESHOLD,
+        })
+    return scores